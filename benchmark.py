@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the orphan scenes to galleries plugin.
+
+Runs OrphanSceneProcessor.process_all against an in-process synthetic Stash
+library, or a recording of real Stash traffic, and reports wall time,
+GraphQL calls, bytes returned and peak Python memory for each match
+strategy. No Stash server or network is needed.
+
+Usage:
+    python benchmark.py --scenes 10000 --images 200000 --galleries 2000
+    python benchmark.py --strategy prefetch --concurrency 4 --latency-ms 5
+    python benchmark.py --strategy prefetch --processes 4 --page-size 10000
+    python benchmark.py --replay traffic.jsonl.gz --strategy query
+    python benchmark.py --matcher --scene-folders 100000 --image-folders 1000000
+    python benchmark.py --records --scenes 100000 --images 1000000
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import stashapi.log as log
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_stash import FakeStash, SyntheticLibrary
+from gallery_matcher import match_folders_batch, should_match_folder
+from orphan_scenes_to_galleries import DEFAULT_SETTINGS, OrphanSceneProcessor
+from records import RecordStore
+from stash_recording import ReplayStash
+
+STRATEGIES = ['query', 'prefetch', 'galleries', 'firstHit']
+
+
+def silence_plugin_logs():
+    """Keep Stash log lines and progress updates off stderr while measuring."""
+    logging.getLogger('StashLogger').setLevel(logging.WARNING)
+    log.DISABLE_PROGRESS = True
+
+
+def make_stash(args):
+    """A fresh Stash stand-in: a recording to replay, or a generated library."""
+    if args.replay:
+        return ReplayStash(args.replay, replay_latency=args.replay_latency)
+
+    library = SyntheticLibrary(
+        scenes=args.scenes,
+        images=args.images,
+        galleries=args.galleries,
+        depth=args.depth,
+        orphan_ratio=args.orphan_ratio,
+        seed=args.seed
+    )
+    return FakeStash(library, latency=args.latency_ms / 1000)
+
+
+def run_once(args, strategy: str, state_dir: str, trace_memory: bool = False):
+    """Run one processing pass on a fresh Stash stand-in."""
+    stash = make_stash(args)
+
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({
+        'matchStrategy': strategy,
+        'dryRun': args.dry_run,
+        'concurrency': args.concurrency,
+        'matchProcesses': args.processes,
+        'pageSize': args.page_size,
+        'statePath': os.path.join(state_dir, f'run_state_{strategy}.json'),
+        'cachePath': os.path.join(state_dir, f'folder_cache_{strategy}.sqlite')
+    })
+    processor = OrphanSceneProcessor(stash, settings)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        processor.process_all()
+        wall = time.perf_counter() - started
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    return processor, stash, wall, peak
+
+
+def run_benchmark(args, strategy: str, state_dir: str) -> dict:
+    """
+    Time a strategy, then measure its peak memory in a second pass, since
+    tracing allocations slows the run down several times over.
+    """
+    processor, stash, wall, _ = run_once(args, strategy, state_dir)
+    peak = None
+    if not args.no_memory:
+        _, _, _, peak = run_once(args, strategy, state_dir, trace_memory=True)
+
+    return {
+        'strategy': strategy,
+        'wall': wall,
+        'stash_time': stash.time_in_stash,
+        'calls': dict(stash.calls),
+        'bytes': stash.bytes_returned,
+        'peak': peak,
+        'misses': dict(getattr(stash, 'misses', {})),
+        'recorded_seconds': getattr(stash, 'recorded_seconds', None),
+        'stats': dict(processor.stats)
+    }
+
+
+def print_result(result: dict):
+    print("\n" + "=" * 70)
+    print(f"Strategy: {result['strategy']}")
+    print("=" * 70)
+    print(f"  Wall time:        {result['wall']:.2f}s")
+    print(f"  In Stash:         {result['stash_time']:.2f}s")
+    print(f"  Plugin time:      {result['wall'] - result['stash_time']:.2f}s")
+    if result['recorded_seconds'] is not None:
+        print(f"  Recorded Stash:   {result['recorded_seconds']:.2f}s")
+    print(f"  GraphQL calls:    {sum(result['calls'].values())}")
+    for method, count in sorted(result['calls'].items()):
+        print(f"    {method}: {count}")
+    print(f"  Bytes returned:   {result['bytes'] / 1e6:.1f} MB")
+    if result['peak'] is not None:
+        print(f"  Peak memory:      {result['peak'] / 1e6:.1f} MB")
+    if result['misses']:
+        print(f"  Not in recording: {result['misses']} - results are not comparable")
+    stats = result['stats']
+    print(f"  Orphans: {stats['total_orphans']}, assigned: {stats['assigned']}, "
+          f"skipped: {stats['skipped']}, errors: {stats['errors']}, folders: {stats['folders']}")
+
+
+def random_folders(rng, count: int, depth: int):
+    """Distinct random folders between 2 and depth levels below LIBRARY_ROOT."""
+    folders = set()
+    while len(folders) < count:
+        levels = rng.randint(2, depth)
+        folders.add('/library' + ''.join(f"/f{rng.randrange(40)}" for _ in range(levels)))
+    return list(folders)
+
+
+def run_matcher_benchmark(args) -> int:
+    """
+    Compare match_folders_batch with calling should_match_folder for every
+    pair. The per-pair time is measured on a sample of scene folders and
+    extrapolated, since the full cross product is far too slow to run.
+    """
+    rng = random.Random(args.seed)
+    image_folders = random_folders(rng, args.image_folders, args.depth + 2)
+    # Scenes sit in image folders, in subfolders of them, or in their parents
+    scene_folders = []
+    for folder in rng.sample(image_folders, min(args.scene_folders, len(image_folders))):
+        placement = rng.random()
+        if placement < 0.5:
+            scene_folders.append(folder)
+        elif placement < 0.8:
+            scene_folders.append(folder + '/video')
+        else:
+            scene_folders.append(str(Path(folder).parent))
+    print(f"Matching {len(scene_folders)} scene folders against {len(image_folders)} image folders")
+
+    started = time.perf_counter()
+    matches = match_folders_batch(scene_folders, image_folders)
+    batch_time = time.perf_counter() - started
+    pairs = sum(len(related.all()) for related in matches.values())
+
+    sample = rng.sample(scene_folders, min(args.matcher_sample, len(scene_folders)))
+    started = time.perf_counter()
+    for scene_folder in sample:
+        parent_path = str(Path(scene_folder).parent)
+        expected = sorted(folder for folder in image_folders
+                          if should_match_folder(folder, scene_folder, parent_path))
+        if sorted(matches[scene_folder].all()) != expected:
+            print(f"\n✗ Batch result differs for {scene_folder}")
+            return 1
+    pair_time = (time.perf_counter() - started) * len(scene_folders) / len(sample)
+
+    print(f"  match_folders_batch:  {batch_time:.2f}s, {pairs} matching pairs")
+    print(f"  should_match_folder:  {pair_time:.0f}s estimated from {len(sample)} scene folders")
+    print(f"  Speedup:              {pair_time / batch_time:.0f}x")
+    print("  ✓ Sampled scene folders match identically")
+    return 0
+
+
+def retained_memory(load) -> tuple:
+    """Run load() and return (its result, bytes it still holds afterwards)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = load()
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def run_records_benchmark(args) -> int:
+    """
+    Compare the memory held by scenes and images kept as decoded GraphQL
+    dicts with the same data kept as records with interned folders.
+    """
+    library = make_stash(args).library
+    # Responses are encoded and decoded so nothing is shared with the library
+    scenes_json = json.dumps(library.scenes)
+    images_json = json.dumps(FakeStash(library).find_images(filter={"per_page": -1}))
+    print(f"Holding {len(library.scenes)} scenes and {library.image_count()} images")
+
+    def load_dicts():
+        return json.loads(scenes_json), json.loads(images_json)
+
+    def load_records():
+        store = RecordStore()
+        scenes = [store.scene(scene) for scene in json.loads(scenes_json)]
+        # The plugin keeps image records; paths are only read while paging
+        images = [store.image(image)[1] for image in json.loads(images_json)]
+        return store, scenes, images
+
+    (scene_dicts, image_dicts), dict_bytes = retained_memory(load_dicts)
+    del scene_dicts, image_dicts
+    (store, _, _), record_bytes = retained_memory(load_records)
+
+    print(f"  GraphQL dicts:  {dict_bytes / 1e6:.1f} MB")
+    print(f"  Records:        {record_bytes / 1e6:.1f} MB, {len(store.folders)} interned folders")
+    print(f"  Reduction:      {1 - record_bytes / dict_bytes:.0%}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenes', type=int, default=10000)
+    parser.add_argument('--images', type=int, default=200000)
+    parser.add_argument('--galleries', type=int, default=2000)
+    parser.add_argument('--depth', type=int, default=4, help='Folder depth of gallery folders')
+    parser.add_argument('--orphan-ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--strategy', choices=STRATEGIES, action='append',
+                        help='Strategy to run, can be repeated (default: all)')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Worker processes matching against the prefetch index')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Simulated round trip added to every call')
+    parser.add_argument('--apply', dest='dry_run', action='store_false',
+                        help='Assign galleries in the fake library instead of a dry run')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Replay a recordTrafficPath recording instead of generating a library')
+    parser.add_argument('--replay-latency', action='store_true',
+                        help='Sleep for the recorded duration of every replayed call')
+    parser.add_argument('--matcher', action='store_true',
+                        help='Benchmark match_folders_batch against per-pair should_match_folder instead')
+    parser.add_argument('--scene-folders', type=int, default=100000)
+    parser.add_argument('--image-folders', type=int, default=1000000)
+    parser.add_argument('--matcher-sample', type=int, default=20,
+                        help='Scene folders matched pair by pair to estimate the per-pair time')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the second, memory-traced pass')
+    parser.add_argument('--records', action='store_true',
+                        help='Compare the memory held by GraphQL dicts and compact records instead')
+    args = parser.parse_args()
+
+    if args.matcher:
+        return run_matcher_benchmark(args)
+    if args.records:
+        return run_records_benchmark(args)
+
+    silence_plugin_logs()
+    if args.replay:
+        print(f"Replaying: {args.replay}")
+    else:
+        print(f"Library: {args.scenes} scenes, {args.images} images, {args.galleries} galleries, "
+              f"depth {args.depth}")
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        results = [run_benchmark(args, strategy, state_dir) for strategy in args.strategy or STRATEGIES]
+
+    for result in results:
+        print_result(result)
+
+    assigned = {result['stats']['assigned'] for result in results}
+    if any(result['misses'] for result in results):
+        print("\n✗ Some calls had no recorded response - record a run with each strategy being compared")
+        return 1
+    if len(assigned) > 1:
+        print("\n✗ Strategies assigned a different number of scenes")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
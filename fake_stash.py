@@ -0,0 +1,466 @@
+"""
+In-process stand-in for StashInterface used by the benchmark and tests.
+Serves a synthetic library generated in memory, so OrphanSceneProcessor can
+be run and measured without a Stash server or network.
+"""
+
+import json
+import random
+import re
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from os.path import commonprefix
+from pathlib import Path
+from typing import Dict, List, Optional
+
+LIBRARY_ROOT = "/library"
+
+_REGEX_META = set('.^$*+?{}[]|()')
+_QUANTIFIERS = set('*+?{')
+
+
+def regex_literal_prefix(pattern: str) -> str:
+    """
+    Find a literal prefix every match of an anchored regex must start with.
+
+    Only handles what the plugin generates: escaped literals and leading
+    (?:a|b) groups. Returns '' if the pattern is not anchored.
+
+    Examples:
+        >>> regex_literal_prefix(r"^/media/a\\-b/[^/]+$")
+        '/media/a-b/'
+        >>> regex_literal_prefix(r"^(?:/media/a(?:/.*)?|/media)$")
+        '/media'
+    """
+    if not pattern.startswith('^'):
+        return ''
+    prefix, _ = _literal_prefix(pattern, 1)
+    return prefix
+
+
+def _literal_prefix(pattern: str, i: int):
+    prefix = ''
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            literal, i = pattern[i + 1], i + 2
+        elif c == '(' and pattern.startswith('(?:', i) and not prefix:
+            # Leading group: common prefix of its alternatives
+            alternatives = []
+            i += 3
+            while True:
+                alternative, i = _literal_prefix(pattern, i)
+                alternatives.append(alternative)
+                i = _skip_to_alternative_end(pattern, i)
+                if i >= len(pattern) or pattern[i] == ')':
+                    break
+                i += 1  # Skip '|'
+            return commonprefix(alternatives), len(pattern)
+        elif c in _REGEX_META:
+            break
+        else:
+            literal, i = c, i + 1
+
+        if i < len(pattern) and pattern[i] in _QUANTIFIERS:
+            break  # The literal is optional or repeated
+        prefix += literal
+    return prefix, i
+
+
+def _skip_to_alternative_end(pattern: str, i: int) -> int:
+    """Advance to the '|' or ')' ending the current alternative."""
+    depth = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '[':
+            i = pattern.index(']', i + 2)
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            if depth == 0:
+                return i
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return i
+        i += 1
+    return i
+
+
+def match_string(value: str, criterion: Optional[Dict]) -> bool:
+    """Evaluate a Stash StringCriterionInput against a value."""
+    if not criterion:
+        return True
+
+    modifier = criterion['modifier']
+    expected = criterion.get('value', '')
+    if modifier == 'INCLUDES':
+        return expected in value
+    if modifier == 'EXCLUDES':
+        return expected not in value
+    if modifier == 'EQUALS':
+        return value == expected
+    if modifier == 'MATCHES_REGEX':
+        return re.search(expected, value) is not None
+    if modifier == 'NOT_MATCHES_REGEX':
+        return re.search(expected, value) is None
+    raise ValueError(f"Unsupported string modifier: {modifier}")
+
+
+def criterion_prefix(criterion: Optional[Dict]) -> str:
+    """Literal prefix every value matching a path criterion starts with."""
+    if not criterion:
+        return ''
+    if criterion['modifier'] == 'MATCHES_REGEX':
+        return regex_literal_prefix(criterion['value'])
+    if criterion['modifier'] in ('INCLUDES', 'EQUALS') and criterion['value'].startswith(LIBRARY_ROOT + '/'):
+        # Every generated path starts with the library root, so a substring
+        # starting with it can only match at the start of a path
+        return criterion['value']
+    return ''
+
+
+def natural_key(path: str) -> List:
+    """
+    Sort key imitating Stash's path collation: case-insensitive, with runs
+    of digits compared as numbers.
+
+    Examples:
+        >>> sorted(["/a/shoot10", "/a/Shoot2", "/a/b"], key=natural_key)
+        ['/a/b', '/a/Shoot2', '/a/shoot10']
+    """
+    parts = re.split(r'(\d+)', path.lower())
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+
+class ImageFolder:
+    """A folder of synthetic images, all in the same gallery (or none)."""
+    __slots__ = ('folder', 'key', 'count', 'first_image_id', 'gallery_id')
+
+    def __init__(self, folder: str, count: int, first_image_id: int, gallery_id: Optional[str]):
+        self.folder = folder
+        # Images are named "img00000.jpg", so all images of a folder sort
+        # together, just before any subfolder starting with a later letter
+        self.key = folder + '/img'
+        self.count = count
+        self.first_image_id = first_image_id
+        self.gallery_id = gallery_id
+
+    def image_path(self, i: int) -> str:
+        return f"{self.folder}/img{i:05d}.jpg"
+
+
+class SyntheticLibrary:
+    """
+    A generated library of scenes, images and folder-based galleries.
+
+    Each gallery is a "shoot" folder of images somewhere under LIBRARY_ROOT.
+    Orphan scenes are spread over the cases the plugin handles: same folder,
+    a video/ subfolder (direct parent match), the shoot's parent folder
+    (child folder match) and unrelated folders (no match). A share of image
+    folders has no gallery at all.
+    """
+
+    def __init__(self, scenes: int = 1000, images: int = 20000, galleries: int = 200,
+                 depth: int = 4, fanout: int = 8, orphan_ratio: float = 0.5, seed: int = 0):
+        rng = random.Random(seed)
+
+        self.galleries: Dict[str, Dict] = {}
+        folders = []
+        for g in range(galleries):
+            parents = ''.join(f"/d{rng.randrange(fanout)}" for _ in range(max(depth - 1, 0)))
+            folder = f"{LIBRARY_ROOT}{parents}/shoot{g:06d}"
+            gallery_id = str(g + 1)
+            self.galleries[gallery_id] = {
+                'id': gallery_id,
+                'title': '',
+                'folder': {'path': folder},
+                'files': [],
+                'updated_at': '2020-01-01T00:00:00Z'
+            }
+            folders.append((folder, gallery_id))
+
+        # Loose image folders without a gallery
+        for k in range(max(galleries // 10, 1)):
+            parents = ''.join(f"/d{rng.randrange(fanout)}" for _ in range(max(depth - 1, 0)))
+            folders.append((f"{LIBRARY_ROOT}{parents}/loose{k:06d}", None))
+
+        per_folder = max(images // len(folders), 1)
+        self.image_folders: List[ImageFolder] = []
+        next_image_id = 1
+        for folder, gallery_id in folders:
+            self.image_folders.append(ImageFolder(folder, per_folder, next_image_id, gallery_id))
+            next_image_id += per_folder
+        self.image_folders.sort(key=lambda image_folder: image_folder.key)
+        self.image_keys = [image_folder.key for image_folder in self.image_folders]
+
+        self.gallery_paths = sorted((gallery['folder']['path'], gallery_id)
+                                    for gallery_id, gallery in self.galleries.items())
+
+        self.scenes: List[Dict] = []
+        gallery_folders = [(folder, gallery_id) for folder, gallery_id in folders if gallery_id]
+        for s in range(scenes):
+            folder, gallery_id = rng.choice(gallery_folders)
+            placement = rng.random()
+            if placement < 0.4:
+                scene_folder = folder
+            elif placement < 0.65:
+                scene_folder = f"{folder}/video"
+            elif placement < 0.8:
+                scene_folder = str(Path(folder).parent)
+            else:
+                scene_folder = f"{LIBRARY_ROOT}/unsorted/u{rng.randrange(max(scenes // 5, 1)):06d}"
+
+            orphan = rng.random() < orphan_ratio
+            self.scenes.append({
+                'id': str(s + 1),
+                'title': '',
+                'organized': rng.random() < 0.1,
+                'files': [{'path': f"{scene_folder}/scene{s:06d}.mp4"}],
+                'galleries': [] if orphan else [{'id': gallery_id}],
+                'created_at': '2020-01-01T00:00:00Z',
+                'updated_at': '2020-01-01T00:00:00Z'
+            })
+        self.scene_ids = [int(scene['id']) for scene in self.scenes]
+
+    def add_image_folder(self, folder: str, count: int, gallery: bool = True,
+                         updated_at: str = '2020-01-01T00:00:00Z') -> Optional[str]:
+        """Add a folder of images, in a new folder-based gallery if gallery is set. Returns the gallery id."""
+        gallery_id = None
+        if gallery:
+            gallery_id = str(len(self.galleries) + 1)
+            self.galleries[gallery_id] = {
+                'id': gallery_id,
+                'title': '',
+                'folder': {'path': folder},
+                'files': [],
+                'updated_at': updated_at
+            }
+            self.gallery_paths = sorted(self.gallery_paths + [(folder, gallery_id)])
+
+        self.image_folders.append(ImageFolder(folder, count, self.image_count() + 1, gallery_id))
+        self.image_folders.sort(key=lambda image_folder: image_folder.key)
+        self.image_keys = [image_folder.key for image_folder in self.image_folders]
+        return gallery_id
+
+    def add_scene(self, folder: str, updated_at: str = '2020-01-01T00:00:00Z') -> str:
+        """Add an orphan scene in a folder. Returns its id."""
+        scene_id = len(self.scenes) + 1
+        self.scenes.append({
+            'id': str(scene_id),
+            'title': '',
+            'organized': False,
+            'files': [{'path': f"{folder}/scene{scene_id:06d}.mp4"}],
+            'galleries': [],
+            'created_at': updated_at,
+            'updated_at': updated_at
+        })
+        self.scene_ids.append(scene_id)
+        return str(scene_id)
+
+    def image_count(self) -> int:
+        return sum(image_folder.count for image_folder in self.image_folders)
+
+
+class FakeStash:
+    """
+    Implements the subset of StashInterface used by OrphanSceneProcessor
+    over a SyntheticLibrary.
+
+    Records call counts, bytes returned (JSON-encoded size of each response)
+    and the time spent inside the fake, optionally adding a fixed latency per
+    call to model network round trips.
+
+    Images are returned in byte order of their paths, or with
+    collation='natural' in the case-insensitive, natural order Stash sorts
+    paths in.
+    """
+
+    def __init__(self, library: SyntheticLibrary, latency: float = 0.0, collation: str = 'binary'):
+        self.library = library
+        self.latency = latency
+        self.collation = collation
+        self.calls = Counter()
+        self.bytes_returned = 0
+        self.time_in_stash = 0.0
+
+    def _respond(self, method: str, started: float, result):
+        self.calls[method] += 1
+        self.bytes_returned += len(json.dumps(result))
+        if self.latency:
+            time.sleep(self.latency)
+        self.time_in_stash += time.perf_counter() - started
+        return result
+
+    @staticmethod
+    def _page(items: List, filter: Dict) -> List:
+        per_page = filter.get('per_page', -1)
+        if per_page is None or per_page < 0:
+            return items
+        page = filter.get('page', 1)
+        return items[(page - 1) * per_page:page * per_page]
+
+    # Scenes
+
+    def _scene_matches(self, scene: Dict, f: Dict) -> bool:
+        if f.get('is_missing') == 'galleries' and scene['galleries']:
+            return False
+        galleries = f.get('galleries')
+        if galleries and galleries['modifier'] == 'IS_NULL' and scene['galleries']:
+            return False
+        if 'organized' in f and scene['organized'] != f['organized']:
+            return False
+        for field in ('updated_at', 'created_at'):
+            if field in f and not scene[field] > f[field]['value']:
+                return False
+        if 'path' in f and not match_string(scene['files'][0]['path'], f['path']):
+            return False
+        return True
+
+    def find_scenes(self, f: dict = {}, filter: dict = {"per_page": -1}, q: str = "",
+                    fragment=None, get_count=False, callback=None):
+        started = time.perf_counter()
+        library = self.library
+
+        start = 0
+        id_criterion = f.get('id')
+        if id_criterion:
+            assert id_criterion['modifier'] == 'GREATER_THAN', id_criterion
+            start = bisect_right(library.scene_ids, int(id_criterion['value']))
+
+        per_page = filter.get('per_page', -1)
+        wanted = None
+        if not get_count and per_page is not None and per_page >= 0:
+            wanted = filter.get('page', 1) * per_page
+
+        matches = []
+        for scene in library.scenes[start:]:
+            if self._scene_matches(scene, f):
+                matches.append(scene)
+                if wanted is not None and len(matches) >= wanted:
+                    break
+
+        if filter.get('direction') == 'DESC':
+            matches.reverse()
+        scenes = [dict(scene, galleries=list(scene['galleries'])) for scene in self._page(matches, filter)]
+        result = (len(matches), scenes) if get_count else scenes
+        return self._respond('find_scenes', started, result)
+
+    def find_scene(self, id, fragment=None):
+        started = time.perf_counter()
+        index = bisect_left(self.library.scene_ids, int(id))
+        scene = None
+        if index < len(self.library.scenes) and self.library.scene_ids[index] == int(id):
+            scene = self.library.scenes[index]
+            scene = dict(scene, galleries=list(scene['galleries']))
+        return self._respond('find_scene', started, scene)
+
+    def update_scenes(self, updates_input):
+        started = time.perf_counter()
+        gallery_ids = updates_input['gallery_ids']
+        assert gallery_ids['mode'] == 'ADD', gallery_ids
+        for scene_id in updates_input['ids']:
+            scene = self.library.scenes[bisect_left(self.library.scene_ids, int(scene_id))]
+            for gallery_id in gallery_ids['ids']:
+                if {'id': gallery_id} not in scene['galleries']:
+                    scene['galleries'].append({'id': gallery_id})
+        return self._respond('update_scenes', started, [{'id': scene_id} for scene_id in updates_input['ids']])
+
+    # Images
+
+    def _image_record(self, image_folder: ImageFolder, i: int) -> Dict:
+        galleries = []
+        if image_folder.gallery_id:
+            gallery = self.library.galleries[image_folder.gallery_id]
+            galleries.append({'id': gallery['id'], 'title': gallery['title'], 'folder': gallery['folder']})
+        return {
+            'id': str(image_folder.first_image_id + i),
+            'title': '',
+            'visual_files': [{'path': image_folder.image_path(i)}],
+            'galleries': galleries
+        }
+
+    def find_images(self, f: dict = {}, filter: dict = {"per_page": -1}, q="",
+                    fragment=None, get_count=False, callback=None):
+        started = time.perf_counter()
+        library = self.library
+        path = f.get('path')
+
+        # Narrow down to folders whose images share the criterion's literal prefix
+        prefix = criterion_prefix(path)
+        lo = bisect_left(library.image_keys, prefix)
+        hi = bisect_left(library.image_keys, prefix + '\U0010ffff') if prefix else len(library.image_keys)
+
+        # Synthetic file names carry no information, so a folder's first
+        # image stands in for all of them when evaluating the path criterion
+        galleries = f.get('galleries')
+        folders = []
+        for image_folder in library.image_folders[lo:hi]:
+            if path and not match_string(image_folder.image_path(0), path):
+                continue
+            if galleries and galleries['modifier'] == 'NOT_NULL' and not image_folder.gallery_id:
+                continue
+            if galleries and galleries['modifier'] == 'IS_NULL' and image_folder.gallery_id:
+                continue
+            folders.append(image_folder)
+        if self.collation == 'natural':
+            folders.sort(key=lambda image_folder: natural_key(image_folder.key))
+
+        total = sum(image_folder.count for image_folder in folders)
+        per_page = filter.get('per_page', -1)
+        if per_page is None or per_page < 0:
+            offset, limit = 0, total
+        else:
+            offset, limit = (filter.get('page', 1) - 1) * per_page, per_page
+
+        images = []
+        for image_folder in folders:
+            if len(images) >= limit:
+                break
+            if offset >= image_folder.count:
+                offset -= image_folder.count
+                continue
+            end = min(image_folder.count, offset + limit - len(images))
+            images.extend(self._image_record(image_folder, i) for i in range(offset, end))
+            offset = 0
+
+        result = (total, images) if get_count else images
+        return self._respond('find_images', started, result)
+
+    # Galleries
+
+    def find_galleries(self, f: dict = {}, filter: dict = {"per_page": -1}, q="",
+                       fragment=None, get_count=False, callback=None):
+        started = time.perf_counter()
+        library = self.library
+        path = f.get('path')
+
+        prefix = criterion_prefix(path)
+        lo = bisect_left(library.gallery_paths, (prefix,))
+        hi = bisect_left(library.gallery_paths, (prefix + '\U0010ffff',)) if prefix else len(library.gallery_paths)
+
+        galleries = []
+        for gallery_path, gallery_id in library.gallery_paths[lo:hi]:
+            gallery = library.galleries[gallery_id]
+            if path and not match_string(gallery_path, path):
+                continue
+            if 'updated_at' in f and not gallery['updated_at'] > f['updated_at']['value']:
+                continue
+            galleries.append(dict(gallery))
+
+        result = self._page(galleries, filter)
+        result = (len(galleries), result) if get_count else result
+        return self._respond('find_galleries', started, result)
+
+    def find_gallery(self, gallery_in, fragment=None):
+        started = time.perf_counter()
+        gallery = self.library.galleries.get(str(gallery_in))
+        return self._respond('find_gallery', started, dict(gallery) if gallery else None)
+
+    def get_configuration(self, fragment=None):
+        return {'plugins': {}}
+
@@ -0,0 +1,154 @@
+"""
+Persistent folder -> gallery cache for orphan scenes to galleries plugin.
+Stores resolved folder matches in a SQLite file so later task runs only
+look up folders whose neighbourhood changed.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+
+
+class FolderGalleryCache:
+    """
+    SQLite-backed cache of scene folder -> match results.
+
+    Both positive results (a JSON-serializable match) and negative results
+    (None, "no gallery here") are stored. Entries expire after max_age_hours
+    and can be invalidated when a gallery near the folder changes.
+
+    Examples:
+        >>> cache = FolderGalleryCache(":memory:")
+        >>> cache.put("/media/shoot", {"id": "1"})
+        >>> cache.get("/media/shoot")
+        (True, {'id': '1'})
+        >>> cache.get("/media/other")
+        (False, None)
+    """
+
+    def __init__(self, path: str, max_age_hours: float = 168):
+        self.path = path
+        self.max_age_seconds = max_age_hours * 3600
+        self._lock = threading.Lock()
+
+        # Matching worker threads share this connection behind self._lock.
+        # Runs of different shards may share the file, so every write is
+        # committed right away instead of holding the write lock for a batch;
+        # in WAL mode with synchronous=NORMAL a commit does not sync to disk
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS folder_matches ("
+            " folder TEXT PRIMARY KEY,"
+            " parent TEXT NOT NULL,"
+            " gallery_id TEXT,"
+            " value TEXT,"
+            " resolved_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS folder_matches_parent ON folder_matches (parent)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS folder_matches_gallery ON folder_matches (gallery_id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute(
+            "DELETE FROM folder_matches WHERE resolved_at < ?",
+            (time.time() - self.max_age_seconds,)
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM folder_matches").fetchone()[0]
+
+    def get(self, folder: str) -> Tuple[bool, object]:
+        """
+        Look up a folder.
+
+        Returns:
+            Tuple of (hit, value). value is None for a cached negative result.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, resolved_at FROM folder_matches WHERE folder = ?", (folder,)
+            ).fetchone()
+
+        if row is None or row[1] < time.time() - self.max_age_seconds:
+            return False, None
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def put(self, folder: str, value, gallery_id: Optional[str] = None):
+        """
+        Store the result for a folder.
+
+        Args:
+            folder: The scene folder
+            value: JSON-serializable match, or None if no gallery matches
+            gallery_id: Id of the matched gallery, used for invalidation
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO folder_matches VALUES (?, ?, ?, ?, ?)",
+                (folder, str(Path(folder).parent), gallery_id,
+                 json.dumps(value) if value is not None else None, time.time())
+            )
+            self._conn.commit()
+
+    def invalidate_gallery(self, gallery_id: str, gallery_folder: Optional[str] = None) -> int:
+        """
+        Drop entries affected by a created or updated gallery.
+
+        Removes entries matched to the gallery and, if the gallery has a
+        folder, every scene folder that could match it: the same folder,
+        its ancestors (the gallery is a descendant) and its direct children
+        (the gallery is their direct parent).
+
+        Returns:
+            Number of entries removed
+        """
+        folders = []
+        if gallery_folder:
+            folders = [gallery_folder] + [str(ancestor) for ancestor in Path(gallery_folder).parents]
+
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM folder_matches WHERE gallery_id = ?", (gallery_id,)
+            ).rowcount
+            if gallery_folder:
+                removed += self._conn.execute(
+                    f"DELETE FROM folder_matches WHERE parent = ? OR folder IN ({','.join('?' * len(folders))})",
+                    [gallery_folder] + folders
+                ).rowcount
+            self._conn.commit()
+        return removed
+
+    def invalidate_galleries(self, galleries: Iterable[Tuple[str, Optional[str]]]) -> int:
+        """Invalidate a list of (gallery_id, gallery_folder) pairs."""
+        return sum(self.invalidate_gallery(gallery_id, folder) for gallery_id, folder in galleries)
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+            self._conn.commit()
+
+    def clear(self):
+        """Remove every cached folder."""
+        with self._lock:
+            self._conn.execute("DELETE FROM folder_matches")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def default_cache_path() -> str:
+    """Cache file location inside the plugin directory."""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'folder_cache.sqlite')
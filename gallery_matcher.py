@@ -3,7 +3,13 @@ Folder matching logic for orphan scenes to galleries plugin.
 This module contains the core matching logic extracted for unit testing.
 """
 
+import multiprocessing
 import os
+import re
+import threading
+from bisect import bisect_left
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 
 def should_match_folder(image_folder: str, scene_folder: str, parent_path: str) -> bool:
@@ -53,3 +59,402 @@ def should_match_folder(image_folder: str, scene_folder: str, parent_path: str)
 
     # Match if either child or direct parent
     return is_child or is_direct_parent
+
+
+class FolderGalleryIndex:
+    """
+    In-memory folder -> gallery index used by the prefetch matching strategy.
+
+    The index is fed every image in the library (sorted by path) once, and
+    remembers only the first image of each folder, mirroring the per-scene
+    queries which always use the first image found in a folder. Lookups then
+    follow the same order as the hierarchical search:
+
+    1. Same folder as the scene
+    2. Direct parent folder, then child/subfolders in sorted order
+
+    Examples:
+        >>> index = FolderGalleryIndex()
+        >>> index.add("/media/shoot/pics", "gallery-1")
+        True
+        >>> index.find_match("/media/shoot")
+        ('/media/shoot/pics', 'gallery-1')
+    """
+
+    def __init__(self):
+        self._seen = set()
+        self._entries = {}
+        self._sorted_folders = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, folder: str, entry) -> bool:
+        """
+        Record the first image of a folder.
+
+        Args:
+            folder: The folder containing the image
+            entry: Value to return on a match, or None if the image has no gallery
+
+        Returns:
+            True if this was the first image of the folder, False if ignored
+        """
+        if folder in self._seen:
+            return False
+
+        self._seen.add(folder)
+        if entry is not None:
+            self._entries[folder] = entry
+            self._sorted_folders = None
+        return True
+
+    def prepare(self):
+        """
+        Build the sorted folder list used by child folder lookups now rather
+        than on the first lookup, e.g. before forking processes that share
+        the index.
+        """
+        if self._sorted_folders is None:
+            self._sorted_folders = sorted(self._entries)
+
+    def find_match(self, scene_folder: str) -> Optional[Tuple[str, object]]:
+        """
+        Find the gallery entry for a scene folder.
+
+        Args:
+            scene_folder: The folder containing the scene
+
+        Returns:
+            Tuple of (matched folder, entry), or None if nothing matches
+        """
+        # Step 1: Same folder
+        if scene_folder in self._entries:
+            return scene_folder, self._entries[scene_folder]
+
+        parent_path = str(Path(scene_folder).parent)
+        if not parent_path or parent_path == scene_folder:
+            return None
+
+        # Step 2: Related folders in sorted order. The direct parent is a prefix
+        # of the scene folder, so it always sorts before any child folder.
+        if parent_path in self._entries:
+            return parent_path, self._entries[parent_path]
+
+        self.prepare()
+
+        prefix = scene_folder + os.sep
+        position = bisect_left(self._sorted_folders, prefix)
+        if position < len(self._sorted_folders):
+            folder = self._sorted_folders[position]
+            if folder.startswith(prefix):
+                return folder, self._entries[folder]
+
+        return None
+
+
+# Index used by IndexMatchPool worker processes
+_worker_index: Optional[FolderGalleryIndex] = None
+
+
+def _init_match_worker(index: Optional[FolderGalleryIndex]):
+    global _worker_index
+    if index is not None:
+        _worker_index = index
+
+
+def _find_matches_in_worker(scene_folders: List[str]) -> List[Optional[Tuple[str, object]]]:
+    return [_worker_index.find_match(scene_folder) for scene_folder in scene_folders]
+
+
+class IndexMatchPool:
+    """
+    Runs FolderGalleryIndex.find_match for many scene folders on a pool of
+    worker processes, so matching against a large index is not limited to
+    one core.
+
+    Where fork is available and this process runs no other threads, workers
+    inherit the index from this process without copying it. Forking while
+    other threads run (e.g. threads started by the caller) can leave locks
+    they hold locked in the workers, so then workers are spawned and the
+    index is pickled once per worker. Folders are sent in chunks and results
+    come back in the order of the folders given. Entries are returned as
+    copies made in the worker.
+    """
+
+    def __init__(self, index: FolderGalleryIndex, processes: int):
+        global _worker_index
+        index.prepare()
+        self.processes = processes
+        if 'fork' in multiprocessing.get_all_start_methods() and threading.active_count() == 1:
+            self.start_method = 'fork'
+            _worker_index = index
+            self._pool = multiprocessing.get_context('fork').Pool(processes, _init_match_worker, (None,))
+        else:
+            self.start_method = 'spawn'
+            self._pool = multiprocessing.get_context('spawn').Pool(processes, _init_match_worker, (index,))
+
+    def find_matches(self, scene_folders: List[str]) -> List[Optional[Tuple[str, object]]]:
+        """find_match for each folder, in the same order."""
+        if not scene_folders:
+            return []
+        # A few chunks per worker balances the load without one message per folder
+        size = -(-len(scene_folders) // (self.processes * 4))
+        chunks = [scene_folders[i:i + size] for i in range(0, len(scene_folders), size)]
+        return [match for chunk in self._pool.map(_find_matches_in_worker, chunks) for match in chunk]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def sorts_before_regex(text: str) -> str:
+    """
+    Regex matching the non-empty strings that sort before text in Python's
+    (code point) order, for use inside a larger pattern.
+
+    A string sorts before text if it is a proper prefix of text, or if it
+    shares a prefix and then has a smaller character. Alternatives are
+    nested, so the pattern grows linearly with text.
+
+    Examples:
+        >>> pattern = sorts_before_regex("b1")
+        >>> [name for name in ["a", "b", "b0", "b1", "b10", "b2", "B9"] if re.fullmatch(pattern, name)]
+        ['a', 'b', 'b0', 'B9']
+    """
+    pattern = ''
+    for i in reversed(range(len(text))):
+        alternatives = []
+        if text[i] != '\x00':
+            alternatives.append(f"[\\x00-{re.escape(chr(ord(text[i]) - 1))}].*")
+        if i < len(text) - 1:
+            # Stopping after this character gives a proper prefix, unless it
+            # is the first character
+            alternatives.append(re.escape(text[i]) + (f"(?:|{pattern})" if pattern else ''))
+        pattern = '|'.join(alternatives)
+    return pattern
+
+
+def subfolder_image_regex(scene_folder: str, before: Optional[str] = None) -> str:
+    """
+    Regex matching the paths of images in subfolders of scene_folder,
+    optionally only in subfolders that sort before the folder before.
+
+    Examples:
+        >>> pattern = subfolder_image_regex("/m", before="/m/b")
+        >>> [path for path in ["/m/1.jpg", "/m/a/1.jpg", "/m/a/x/1.jpg", "/m/b/1.jpg"] if re.match(pattern, path)]
+        ['/m/a/1.jpg', '/m/a/x/1.jpg']
+    """
+    sep = re.escape(os.sep)
+    folders = '.+'
+    if before is not None:
+        folders = f"(?:{sorts_before_regex(before[len(scene_folder) + 1:])})"
+    return f"^{re.escape(scene_folder)}{sep}{folders}{sep}[^{sep}]+$"
+
+
+def find_first_descendant(scene_folder: str,
+                          list_images: Callable[[Optional[str], int], Iterable[Tuple[str, object]]]
+                          ) -> Optional[Tuple[str, object]]:
+    """
+    Find the first (in sorted folder order) subfolder of scene_folder whose
+    first image has a gallery, reading as few images as possible.
+
+    This gives the same answer as FolderGalleryIndex.find_match does for
+    child folders. Stash sorts paths with its own case-insensitive, natural
+    collation, so the first folder with a gallery it lists need not be the
+    first in Python's order. Each one found is only a candidate: the search
+    goes on among the folders that sort before it (a narrower query), and
+    stops once none of them is left. The images already read from those
+    folders come first in the narrower query too, so they are skipped.
+
+    Args:
+        scene_folder: The folder containing the scene
+        list_images: Called with (before, skip). Returns (image path, entry)
+            for the images in subfolders of scene_folder (only those sorting
+            before the folder before, if not None), in Stash's path order,
+            leaving out the first skip. entry is None if the image has no
+            gallery. Consumed lazily, so pages can be fetched on demand
+
+    Returns:
+        Tuple of (matched folder, entry), or None if nothing matches
+
+    Examples:
+        >>> images = [("/m/s/a/1.jpg", None), ("/m/s/shoot2/1.jpg", "g2"), ("/m/s/shoot10/1.jpg", "g3")]
+        >>> list_images = lambda before, skip: [image for image in images
+        ...                                     if before is None or os.path.dirname(image[0]) < before][skip:]
+        >>> find_first_descendant("/m/s", list_images)
+        ('/m/s/shoot10', 'g3')
+    """
+    first_entries = {}
+    image_counts = {}  # Images read per folder, among those the current query returns
+    best = None
+    while True:
+        for image_path, entry in list_images(best, sum(image_counts.values())):
+            folder = str(Path(image_path).parent)
+            image_counts[folder] = image_counts.get(folder, 0) + 1
+            if folder not in first_entries:
+                first_entries[folder] = entry
+                if entry is not None:
+                    best = folder
+                    break
+        else:
+            return (best, first_entries[best]) if best is not None else None
+
+        image_counts = {folder: count for folder, count in image_counts.items() if folder < best}
+
+
+class RelatedFolders(NamedTuple):
+    """
+    Folders related to a scene folder, as returned by FolderTrie.find_related
+    and match_folders_batch.
+    """
+    same_folder: Optional[str]
+    parent: Optional[str]
+    descendants: List[str]
+
+    def all(self) -> List[str]:
+        """All related folders: same folder, direct parent, then descendants."""
+        folders = [folder for folder in (self.same_folder, self.parent) if folder is not None]
+        return folders + self.descendants
+
+
+def match_folders_batch(scene_folders: Iterable[str], image_folders: Iterable[str]) -> Dict[str, RelatedFolders]:
+    """
+    Match many scene folders against many image/gallery folders at once.
+
+    Gives the same matches as calling should_match_folder for every pair,
+    without comparing every pair. The image folders are sorted once; the
+    descendants of a scene folder then form one contiguous range of the
+    sorted list, found by bisection. Runs in O((n + m) log m) plus the size
+    of the output for n scene folders and m image folders.
+
+    Args:
+        scene_folders: Folders containing scenes
+        image_folders: Folders containing images or galleries
+
+    Returns:
+        Mapping of each distinct scene folder to its RelatedFolders, with
+        descendants in sorted order
+
+    Examples:
+        >>> matches = match_folders_batch(["/media/shoot"], ["/media", "/media/shoot/pics", "/media/other"])
+        >>> matches["/media/shoot"].all()
+        ['/media', '/media/shoot/pics']
+    """
+    folders = sorted(set(image_folders))
+    present = set(folders)
+    # Every descendant of a folder sorts between folder + sep and folder + the next character
+    after_sep = chr(ord(os.sep) + 1)
+
+    matches = {}
+    for scene_folder in set(scene_folders):
+        parent_path = str(Path(scene_folder).parent)
+        start = bisect_left(folders, scene_folder + os.sep)
+        end = bisect_left(folders, scene_folder + after_sep, start)
+        matches[scene_folder] = RelatedFolders(
+            scene_folder if scene_folder in present else None,
+            parent_path if parent_path != scene_folder and parent_path in present else None,
+            folders[start:end]
+        )
+    return matches
+
+
+class _FolderTrieNode:
+    __slots__ = ('children', 'folder')
+
+    def __init__(self):
+        self.children = {}
+        self.folder = None
+
+
+class FolderTrie:
+    """
+    Path-component trie of gallery/image folders for bulk hierarchical lookups.
+
+    Where should_match_folder compares one pair of folders, the trie answers
+    "which known folders match this scene folder" in time proportional to the
+    depth of the scene folder plus the number of results, following the same
+    rules (same folder, descendants, direct parent only).
+
+    Examples:
+        >>> trie = FolderTrie()
+        >>> for folder in ["/media", "/media/shoot/pics", "/media/other"]:
+        ...     _ = trie.add(folder)
+        >>> trie.find_related("/media/shoot").all()
+        ['/media', '/media/shoot/pics']
+    """
+
+    def __init__(self):
+        self._root = _FolderTrieNode()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, folder: str) -> bool:
+        node = self._find_node(folder)
+        return node is not None and node.folder is not None
+
+    def add(self, folder: str) -> bool:
+        """
+        Add a folder to the trie.
+
+        Returns:
+            True if the folder was added, False if it was already present
+        """
+        node = self._root
+        for component in folder.split(os.sep):
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _FolderTrieNode()
+            node = child
+
+        if node.folder is not None:
+            return False
+
+        node.folder = folder
+        self._size += 1
+        return True
+
+    def _find_node(self, folder: str) -> Optional[_FolderTrieNode]:
+        node = self._root
+        for component in folder.split(os.sep):
+            node = node.children.get(component)
+            if node is None:
+                return None
+        return node
+
+    def find_related(self, scene_folder: str) -> RelatedFolders:
+        """
+        Find all folders that should_match_folder would match for a scene folder.
+
+        Args:
+            scene_folder: The folder containing the scene
+
+        Returns:
+            RelatedFolders with the same folder, direct parent and descendants
+            (each None/empty if not present in the trie)
+        """
+        same_folder = None
+        descendants = []
+
+        node = self._find_node(scene_folder)
+        if node is not None:
+            same_folder = node.folder
+
+            # Every node below the scene folder is a descendant
+            stack = list(node.children.values())
+            while stack:
+                child = stack.pop()
+                if child.folder is not None:
+                    descendants.append(child.folder)
+                stack.extend(child.children.values())
+
+        parent = None
+        parent_path = str(Path(scene_folder).parent)
+        if parent_path != scene_folder:
+            parent_node = self._find_node(parent_path)
+            if parent_node is not None:
+                parent = parent_node.folder
+
+        return RelatedFolders(same_folder, parent, descendants)
@@ -0,0 +1,96 @@
+"""
+Match plans for orphan scenes to galleries plugin.
+A plan run writes every proposed scene -> gallery assignment to a JSON or
+CSV file instead of assigning it, so the matches can be reviewed (and
+edited) and then applied later without matching again.
+"""
+
+import csv
+import json
+import os
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+PLAN_FIELDS = ['scene_id', 'scene_title', 'scene_folder', 'gallery_id', 'gallery_title', 'gallery_folder',
+               'match_folder', 'reason', 'via']
+
+
+class PlanEntry(NamedTuple):
+    """One proposed assignment of a scene to a gallery."""
+    scene_id: str
+    scene_title: str
+    scene_folder: str
+    gallery_id: str
+    gallery_title: str
+    gallery_folder: str  # Empty for zip and manually created galleries
+    match_folder: str  # Folder the gallery was found in
+    reason: str  # 'same folder', 'child folder' or 'parent folder'
+    via: str  # How the gallery was found, as logged
+
+
+def match_reason(scene_folder: str, match_folder: str) -> str:
+    """
+    Describe how the folder a gallery was found in relates to the scene folder.
+
+    Examples:
+        >>> match_reason("/media/shoot", "/media/shoot")
+        'same folder'
+        >>> match_reason("/media/shoot", "/media/shoot/pics")
+        'child folder'
+        >>> match_reason("/media/shoot/video", "/media/shoot")
+        'parent folder'
+    """
+    if match_folder == scene_folder:
+        return 'same folder'
+    if Path(scene_folder) in Path(match_folder).parents:
+        return 'child folder'
+    return 'parent folder'
+
+
+def is_csv(path: str) -> bool:
+    return path.lower().endswith('.csv')
+
+
+def write_plan(path: str, entries: List[PlanEntry], created: str, scope: Optional[str] = None):
+    """
+    Write a plan as CSV if the path ends in .csv, JSON otherwise.
+
+    Written to a temporary file and renamed, so a failed write keeps the
+    previous plan.
+    """
+    with open(path + '.tmp', 'w', newline='', encoding='utf-8') as f:
+        if is_csv(path):
+            writer = csv.writer(f)
+            writer.writerow(PLAN_FIELDS)
+            writer.writerows(entries)
+        else:
+            json.dump({
+                'created': created,
+                'scope': scope,
+                'assignments': [entry._asdict() for entry in entries]
+            }, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def read_plan(path: str) -> List[PlanEntry]:
+    """
+    Read a plan written by write_plan.
+
+    Only scene_id and gallery_id are required, so rows can be written or
+    trimmed by hand.
+
+    Raises:
+        ValueError: If an assignment has no scene or gallery id
+    """
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        if is_csv(path):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)['assignments']
+
+    entries = []
+    for number, row in enumerate(rows, 1):
+        if not row.get('scene_id') or not row.get('gallery_id'):
+            raise ValueError(f"Assignment {number} in {path} needs a scene_id and a gallery_id")
+        entries.append(PlanEntry(*(str(row.get(field) or '') for field in PLAN_FIELDS)))
+    return entries
@@ -3,355 +3,1470 @@ from stashapi.stashapp import StashInterface
 import sys
 import json
 import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 
 # Import the matching logic
-from gallery_matcher import should_match_folder
+from gallery_cache import FolderGalleryCache, default_cache_path
+from gallery_matcher import (FolderGalleryIndex, IndexMatchPool, find_first_descendant, match_folders_batch,
+                             should_match_folder, subfolder_image_regex)
+from match_plan import PlanEntry, match_reason, read_plan, write_plan
+from records import GalleryRecord, ImageRecord, RecordStore, SceneRecord
+from run_metrics import InstrumentedStash, RunMetrics
+from stash_recording import RecordingStash
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMAGE_FRAGMENT = 'id title visual_files { ... on ImageFile { path } } galleries { id title folder { path } }'
+GALLERY_FRAGMENT = 'id title folder { path }'
+
+# Images are always requested sorted by path so that "the first image in a
+# folder" means the same thing for per-scene queries and the prefetch index.
+IMAGE_SORT = {"sort": "path", "direction": "ASC"}
+
+
+DEFAULT_SETTINGS = {
+    "excludeOrganized": False,
+    "dryRun": False,
+    "matchStrategy": "query",
+    "pageSize": 1000,
+    "assignBatchSize": 100,
+    "concurrency": 1,
+    "persistentCache": False,
+    "cacheMaxAgeHours": 168,
+    "enableHooks": False,
+    "metricsReportPath": "",
+    "recordTrafficPath": "",
+    "checkpointPages": 10,
+    "maxRuntimeMinutes": 0,
+    "matchProcesses": 1,
+    "planPath": "match_plan.json"
+}
+
+
+def utc_timestamp() -> str:
+    """Current time in the format Stash accepts for timestamp filters."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parse a 'k/n' shard argument into (k, n), with shards numbered from 1.
+
+    Examples:
+        >>> parse_shard("2/4")
+        (2, 4)
+    """
+    try:
+        k, n = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{shard}', expected 'k/n' such as '1/4'")
+    if not 1 <= k <= n:
+        raise ValueError(f"Invalid shard '{shard}', k must be between 1 and n")
+    return k, n
+
+
+def folder_shard(folder: Optional[str], shards: int) -> int:
+    """Shard (numbered from 1) that a scene folder belongs to, stable across runs and machines."""
+    return zlib.crc32((folder or '').encode('utf-8')) % shards + 1
+
+
+class FolderMatch(NamedTuple):
+    """Gallery resolved for a scene folder."""
+    gallery: GalleryRecord
+    folder: str  # Folder the gallery was found in
+    via: str  # How it was found, for logging
 
 
 class OrphanSceneProcessor:
     def __init__(self, stash: StashInterface, settings: Dict):
-        self.stash = stash
+        # Every Stash call is timed and attributed to the current phase
+        self.metrics = RunMetrics()
+        self.stash = InstrumentedStash(stash, self.metrics)
         self.settings = settings
+        # Task arguments restricting the run to part of the library, so
+        # several runs can process different parts in parallel
+        self.path_prefix = (settings.get('pathPrefix') or '').rstrip(os.sep) or None
+        self.shard = parse_shard(settings['shard']) if settings.get('shard') else None
         self.stats = {
             'total_orphans': 0,
             'assigned': 0,
             'skipped': 0,
-            'errors': 0
+            'errors': 0,
+            'folders': 0,
+            'cache_hits': 0,
+            'remaining': 0
         }
-
-    def get_scene_identifier(self, scene: Dict) -> str:
+        # Scenes, images and galleries are kept as compact records with
+        # interned folders rather than GraphQL dicts
+        self.records = RecordStore()
+        self.gallery_index: Optional[FolderGalleryIndex] = None
+        # Worker processes matching folders against gallery_index, if enabled
+        self.match_pool: Optional[IndexMatchPool] = None
+        self.folder_matches: Dict[str, Optional[FolderMatch]] = {}
+        self.first_images: Dict[str, Optional[ImageRecord]] = {}
+        self.pending_assignments: Dict[str, Tuple[GalleryRecord, List[SceneRecord]]] = {}
+        self.pending_count = 0  # Scenes queued in pending_assignments
+        self.cache: Optional[FolderGalleryCache] = None
+        # Folders whose orphan scenes are still orphaned after this run
+        self.unmatched_folders: Set[str] = set()
+        # Start of the full run being checkpointed, None when not checkpointing
+        self.checkpoint_run: Optional[str] = None
+        # Set when maxRuntimeMinutes ran out before every orphan was processed
+        self.out_of_time = False
+        # Proposed assignments of a plan run, None when assigning
+        self.plan: Optional[List[PlanEntry]] = None
+        # Guards stats and caches shared with matching worker threads
+        self.lock = threading.Lock()
+
+    def increment_stat(self, key: str, amount: int = 1):
+        """Thread-safe update of a counter in self.stats."""
+        with self.lock:
+            self.stats[key] += amount
+
+    def get_scene_identifier(self, scene: SceneRecord) -> str:
         """Get a human-readable identifier for a scene."""
-        title = scene.get('title', '').strip()
-        if title:
-            return f"'{title}'"
+        if scene.title:
+            return f"'{scene.title}'"
 
         # Fall back to filename if no title
-        files = scene.get('files', [])
-        if files:
-            file_path = files[0].get('path', '')
-            if file_path:
-                filename = Path(file_path).name
-                return f"file:{filename}"
+        if scene.file_name:
+            return f"file:{scene.file_name}"
 
-        return f"ID:{scene['id']}"
+        return f"ID:{scene.id}"
 
-    def get_gallery_identifier(self, gallery: Dict) -> str:
+    def get_gallery_identifier(self, gallery: GalleryRecord) -> str:
         """Get a human-readable identifier for a gallery."""
-        title = gallery.get('title', '').strip()
-        if title:
-            return f"'{title}'"
+        if gallery.title:
+            return f"'{gallery.title}'"
 
         # Fall back to folder path if no title
-        folder = gallery.get('folder', {})
-        if folder:
-            folder_path = folder.get('path', '')
-            if folder_path:
-                folder_name = Path(folder_path).name
-                return f"folder:{folder_name}"
-
-        return f"ID:{gallery['id']}"
+        if gallery.folder:
+            return f"folder:{Path(gallery.folder).name}"
 
-    def get_orphan_scenes(self) -> List[Dict]:
-        """Find all scenes without galleries."""
-        # Get all scenes and filter for those without galleries
-        log.info("Fetching all scenes to find orphans...")
+        return f"ID:{gallery.id}"
 
-        all_scenes = []
-        page = 1
-        per_page = 100
-
-        while True:
-            scenes = self.stash.find_scenes(
-                f={},  # Empty filter to get all scenes
-                filter={"page": page, "per_page": per_page},
-                fragment='id title date organized files { path } galleries { id }'
-            )
-
-            if not scenes:
-                break
+    def get_path_prefix_criterion(self) -> Dict:
+        """Path criterion selecting files below pathPrefix."""
+        return {
+            "modifier": "MATCHES_REGEX",
+            "value": f"^{re.escape(self.path_prefix)}{re.escape(os.sep)}"
+        }
 
-            all_scenes.extend(scenes)
-            page += 1
+    def in_scope(self, folder: str) -> bool:
+        """Whether a folder is inside pathPrefix, if one is set."""
+        return self.path_prefix is None or folder == self.path_prefix or folder.startswith(self.path_prefix + os.sep)
 
-            # Show progress
-            log.progress(page * per_page / 1000)  # Rough progress estimate
+    def parent_out_of_scope(self, scene_folder: str) -> bool:
+        """Whether pathPrefix cuts off the direct parent lookup of a scene folder."""
+        parent_path = self.records.folders.parent_path(scene_folder)
+        return bool(parent_path) and parent_path != scene_folder and not self.in_scope(parent_path)
 
-        # Filter for scenes without galleries
-        orphan_scenes = []
-        for scene in all_scenes:
-            galleries = scene.get('galleries', [])
+    def in_shard(self, scene: SceneRecord) -> bool:
+        """
+        Whether a scene belongs to this run's hash shard. Scenes are sharded
+        by folder, so every folder is resolved by exactly one shard.
+        """
+        if self.shard is None:
+            return True
+        k, n = self.shard
+        return folder_shard(self.get_scene_folder(scene), n) == k
+
+    def get_scope_name(self) -> str:
+        """Human readable description of the part of the library this run covers."""
+        parts = []
+        if self.path_prefix:
+            parts.append(f"path prefix {self.path_prefix}")
+        if self.shard:
+            parts.append(f"shard {self.shard[0]} of {self.shard[1]}")
+        return ', '.join(parts) or 'whole library'
+
+    def scoped_path(self, path: str) -> str:
+        """
+        Per-scope name for a state file, so runs over different parts of the
+        library keep separate run state and checkpoints.
 
-            # Skip if scene has galleries
-            if galleries and len(galleries) > 0:
-                continue
+        e.g. run_state.json -> run_state.shard-1-of-4.json
+        """
+        suffix = ''
+        if self.path_prefix:
+            suffix += f".prefix-{zlib.crc32(self.path_prefix.encode('utf-8')):08x}"
+        if self.shard:
+            suffix += f".shard-{self.shard[0]}-of-{self.shard[1]}"
+        root, ext = os.path.splitext(path)
+        return root + suffix + ext
+
+    def get_orphan_scene_filter(self, extra_filter: Optional[Dict] = None) -> Dict:
+        """Build the find_scenes filter selecting orphan scenes, plus any extra conditions."""
+        query = dict(extra_filter or {})
+        query["is_missing"] = "galleries"
+
+        # Folder filters of incremental runs are already inside the prefix
+        if self.path_prefix and "path" not in query:
+            query["path"] = self.get_path_prefix_criterion()
+
+        # Skip organized scenes if configured
+        if self.settings.get('excludeOrganized', False):
+            query["organized"] = False
+
+        return query
+
+    def count_orphan_scenes(self, extra_filter: Optional[Dict] = None) -> int:
+        """Count scenes without galleries, in every hash shard."""
+        count, _ = self.stash.find_scenes(
+            f=self.get_orphan_scene_filter(extra_filter),
+            filter={"per_page": 1},
+            fragment='id',
+            get_count=True
+        )
+        return count
+
+    def get_shard_share(self, count: int) -> int:
+        """Number of scenes out of count expected in this run's hash shard."""
+        if self.shard:
+            # Stash cannot filter by folder hash, so assume an even split
+            return -(-count // self.shard[1])
+        return count
+
+    def get_estimate_label(self) -> str:
+        """Prefix for scene counts that are only estimated, which is the case for a shard before it ran."""
+        return 'about ' if self.shard else ''
+
+    def get_orphan_scene_pages(self, extra_filter: Optional[Dict] = None, after_id: int = 0,
+                               count: Optional[int] = None) -> Iterator[List[SceneRecord]]:
+        """
+        Yield pages of scenes without galleries with ids above after_id,
+        optionally narrowed by extra find_scenes filter conditions.
+
+        Orphans are filtered by Stash, so only orphan scenes cross the wire and
+        at most one page is held in memory. Pages are requested in id order
+        after the last id seen rather than by page number: assigning galleries
+        while iterating removes scenes from the result set, which would shift
+        numbered pages and skip scenes.
+
+        With concurrency above 1, pages are requested in waves of up to
+        concurrency pages at once, sized by count: the number of scenes the
+        pages will hold in every shard, counted here unless given. Each
+        wave is requested by page number after the last id of the previous
+        wave, and is complete before its first page is yielded, so scenes
+        assigned meanwhile cannot shift its pages.
+
+        With a hash shard, scenes of other shards are dropped from each page
+        and pages left empty are skipped.
+        """
+        log.info("Fetching orphan scenes...")
+
+        per_page = int(self.settings.get('pageSize') or 1000)
+        concurrency = int(self.settings.get('concurrency') or 1)
+        last_id = after_id
+
+        pages_left = 0
+        if concurrency > 1:
+            if count is None:
+                count = self.count_orphan_scenes(
+                    dict(extra_filter or {}, id={"value": last_id, "modifier": "GREATER_THAN"})
+                )
+            pages_left = -(-count // per_page)
+            log.debug(f"Fetching {count} orphan scenes in {pages_left} pages, {concurrency} at a time")
+
+        def fetch_page(page: int) -> List[Dict]:
+            query = self.get_orphan_scene_filter(extra_filter)
+            query["id"] = {"value": last_id, "modifier": "GREATER_THAN"}
+            return self.stash.find_scenes(
+                f=query,
+                filter={"page": page, "per_page": per_page, "sort": "id", "direction": "ASC"},
+                fragment='id title files { path }'
+            )
 
-            # Skip organized scenes if configured
-            if self.settings.get('excludeOrganized', False) and scene.get('organized', False):
-                continue
+        with ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else nullcontext() as executor:
+            while True:
+                # Scenes created since counting are fetched one page at a time
+                wave = min(max(pages_left, 1), concurrency)
+                if wave > 1:
+                    pages = list(executor.map(fetch_page, range(1, wave + 1)))
+                else:
+                    pages = [fetch_page(1)]
+                pages_left -= wave
+
+                for scenes in pages:
+                    records = [record for record in map(self.records.scene, scenes) if self.in_shard(record)]
+                    if records:
+                        yield records
+
+                fetched = [scenes for scenes in pages if scenes]
+                if not fetched:
+                    break
+                last_id = int(fetched[-1][-1]['id'])
+                if len(pages[-1]) < per_page:
+                    break
+
+    def get_folder_scene_filter(self, folders: List[str]) -> Dict:
+        """Build a find_scenes filter selecting scenes directly inside any of the folders."""
+        sep = re.escape(os.sep)
+        pattern = '|'.join(re.escape(folder) for folder in folders)
+        return {
+            "path": {
+                "modifier": "MATCHES_REGEX",
+                "value": f"^(?:{pattern}){sep}[^{sep}]+$"
+            }
+        }
 
-            orphan_scenes.append(scene)
+    def get_gallery_scene_filter(self, gallery_folder: str) -> Dict:
+        """
+        Build a find_scenes filter selecting scenes a gallery folder could match:
+        scenes in the gallery folder or any of its ancestors (the gallery is in
+        their subfolder), and scenes in its direct child folders (the gallery
+        is their direct parent).
+        """
+        sep = re.escape(os.sep)
+        folders = [gallery_folder] + [
+            str(ancestor) for ancestor in Path(gallery_folder).parents
+            if ancestor != ancestor.parent  # Scenes at the root match nothing below it
+        ]
+        pattern = '|'.join(re.escape(folder) for folder in folders)
+        return {
+            "path": {
+                "modifier": "MATCHES_REGEX",
+                "value": f"^(?:(?:{pattern}){sep}[^{sep}]+|{re.escape(gallery_folder)}{sep}[^{sep}]+{sep}[^{sep}]+)$"
+            }
+        }
 
-        log.info(f"Found {len(orphan_scenes)} orphan scenes out of {len(all_scenes)} total scenes")
-        self.stats['total_orphans'] = len(orphan_scenes)
+    def get_image_entry(self, image: Optional[ImageRecord]) -> Optional[Tuple[str, GalleryRecord]]:
+        """(image id, first gallery) for an image, or None if it has no gallery."""
+        if image is None or image.gallery is None:
+            return None
+        return image.id, image.gallery
 
-        return orphan_scenes
+    def get_image_query(self, path_regex: str) -> Dict:
+        """
+        Build a find_images filter for images whose path matches a regex.
 
-    def get_images_in_folder(self, folder_path: str) -> List[Dict]:
-        """Find all images in a specific folder path."""
-        # Query for images where the path starts with the folder path
-        # Use INCLUDES modifier to find images whose path contains the folder
+        With the 'firstHit' strategy only images already in a gallery are
+        returned, so the first result is the answer and images without a
+        gallery are never transferred.
+        """
         query = {
             "path": {
-                "modifier": "INCLUDES",
-                "value": folder_path
+                "modifier": "MATCHES_REGEX",
+                "value": path_regex
             }
         }
+        if self.settings.get('matchStrategy') == 'firstHit':
+            query["galleries"] = {"value": [], "modifier": "NOT_NULL"}
+        return query
+
+    def get_first_image_in_folder(self, folder_path: str) -> Optional[ImageRecord]:
+        """
+        Find the first image (sorted by path) directly inside a folder, or
+        the first one in a gallery with the 'firstHit' strategy.
+
+        Uses an anchored regex so subfolders and unrelated paths containing
+        the folder name are excluded by Stash, and fetches a single image.
+        Results are cached, so sibling scene folders share the lookup of
+        their parent.
+        """
+        with self.lock:
+            if folder_path in self.first_images:
+                return self.first_images[folder_path]
+
+        sep = re.escape(os.sep)
+        query = self.get_image_query(f"^{re.escape(folder_path)}{sep}[^{sep}]+$")
+
+        try:
+            images = self.stash.find_images(
+                f=query,
+                filter={"per_page": 1, **IMAGE_SORT},
+                fragment=IMAGE_FRAGMENT
+            )
+        except Exception as e:
+            log.debug(f"Error finding images in folder {folder_path}: {str(e)}")
+            return None
+
+        converted = self.records.image(images[0]) if images else None
+        image = converted[1] if converted else None
+        with self.lock:
+            self.first_images[folder_path] = image
+        return image
+
+    def get_images_in_subfolders(self, scene_folder: str, before: Optional[str] = None,
+                                 skip: int = 0) -> Iterator[Tuple[str, ImageRecord]]:
+        """
+        Yield (path, image) for images in subfolders of scene_folder, in
+        Stash's path order, optionally only in subfolders that sort before
+        the folder before and leaving out the first skip images.
+
+        Pages are only requested as the caller consumes them, so a caller
+        that stops at the first match never holds more than one page. The
+        first image usually decides the match, so it is requested on its own
+        before paging.
+        """
+        query = self.get_image_query(subfolder_image_regex(scene_folder, before))
+        page_size = int(self.settings.get('pageSize') or 1000)
+
+        offset, per_page = skip, 1
+        while True:
+            try:
+                images = self.stash.find_images(
+                    f=query,
+                    filter={"page": offset // per_page + 1, "per_page": per_page, **IMAGE_SORT},
+                    fragment=IMAGE_FRAGMENT
+                )
+            except Exception as e:
+                log.debug(f"Error finding images in subfolders of {scene_folder}: {str(e)}")
+                return
+
+            # A page can start before offset after switching to full pages
+            new_images = (images or [])[offset % per_page:]
+            for image in new_images:
+                converted = self.records.image(image)
+                if converted:
+                    yield converted
+
+            if not images or len(images) < per_page:
+                return
+            offset, per_page = offset + len(new_images), page_size
+
+    def get_gallery_folder(self, gallery: Dict) -> Optional[str]:
+        """Get the folder a gallery's images live in (the zip file for zip galleries)."""
+        folder = (gallery.get('folder') or {}).get('path')
+        if folder:
+            return folder
+
+        files = gallery.get('files') or []
+        return files[0].get('path') if files else None
+
+    def get_galleries_updated_since(self, timestamp: str) -> List[Dict]:
+        """Find galleries created or updated after a timestamp."""
+        query = {"updated_at": {"value": timestamp, "modifier": "GREATER_THAN"}}
+        if self.path_prefix:
+            query["path"] = self.get_path_prefix_criterion()
+        return self.stash.find_galleries(
+            f=query,
+            filter={"per_page": -1},
+            fragment='id folder { path } files { path }'
+        ) or []
+
+    def open_cache(self) -> FolderGalleryCache:
+        """
+        Open the persistent folder -> gallery cache and drop entries made
+        stale by galleries created or updated since the last run.
+        """
+        cache = FolderGalleryCache(
+            self.settings.get('cachePath') or default_cache_path(),
+            max_age_hours=float(self.settings.get('cacheMaxAgeHours') or 168)
+        )
+
+        # Results from a different strategy may differ, so start over
+        strategy = self.settings.get('matchStrategy', 'query')
+        if cache.get_meta('strategy') != strategy:
+            cache.clear()
+            cache.set_meta('strategy', strategy)
+
+        sync_started = utc_timestamp()
+        last_sync = cache.get_meta('last_sync')
+        if last_sync:
+            changed = self.get_galleries_updated_since(last_sync)
+            removed = cache.invalidate_galleries(
+                (gallery['id'], self.get_gallery_folder(gallery)) for gallery in changed
+            )
+            log.info(f"Folder cache: {len(changed)} galleries changed since {last_sync}, "
+                     f"{removed} cached folders invalidated")
+
+        # Entries are now valid as of sync_started; anything changing later is
+        # picked up by the next run even if this one does not finish
+        cache.set_meta('last_sync', sync_started)
+
+        log.info(f"Folder cache: {len(cache)} cached folders in {cache.path}")
+        return cache
 
+    def cache_get(self, scene_folder: str) -> Tuple[bool, object]:
+        """Look up a folder in the persistent cache; a locked cache file counts as a miss."""
         try:
+            return self.cache.get(scene_folder)
+        except sqlite3.OperationalError as e:
+            log.warning(f"Folder cache lookup failed for {scene_folder}: {str(e)}")
+            return False, None
+
+    def cache_put(self, scene_folder: str, match: Optional[FolderMatch]):
+        """Store a folder result in the persistent cache, skipping it if the cache file is locked."""
+        try:
+            self.cache.put(scene_folder, [match.gallery.to_graphql(), match.folder, match.via] if match else None,
+                           match.gallery.id if match else None)
+        except sqlite3.OperationalError as e:
+            log.warning(f"Folder cache update failed for {scene_folder}: {str(e)}")
+
+    def build_gallery_index(self) -> FolderGalleryIndex:
+        """
+        Page through every image in the library once and build a
+        folder -> gallery index for the prefetch matching strategy.
+        """
+        log.info("Prefetching images to build folder -> gallery index...")
+
+        index = FolderGalleryIndex()
+        page = 1
+        per_page = int(self.settings.get('pageSize') or 1000)
+        total_images = 0
+
+        query = {"path": self.get_path_prefix_criterion()} if self.path_prefix else {}
+        while True:
             images = self.stash.find_images(
                 f=query,
-                filter={"per_page": -1},
-                fragment='id title visual_files { ... on ImageFile { path } } galleries { id title folder { path } }'
+                filter={"page": page, "per_page": per_page, **IMAGE_SORT},
+                fragment=IMAGE_FRAGMENT
             )
 
             if not images:
-                return []
+                break
 
-            # Filter to only images actually in this specific folder (not subfolders)
-            folder_images = []
             for image in images:
-                # Images have visual_files array (union of VideoFile | ImageFile)
-                visual_files = image.get('visual_files', [])
-                if visual_files and len(visual_files) > 0:
-                    # Get path from the first file
-                    image_path = visual_files[0].get('path', '')
-                    if image_path:
-                        image_folder = str(Path(image_path).parent)
-                        if image_folder == folder_path:
-                            folder_images.append(image)
-
-            return folder_images
-        except Exception as e:
-            log.debug(f"Error finding images in folder {folder_path}: {str(e)}")
-            return []
+                converted = self.records.image(image)
+                if converted:
+                    _, record = converted
+                    index.add(self.records.folders.path(record.folder_id), self.get_image_entry(record))
 
-    def get_images_in_parent_folders(self, parent_path: str, scene_folder: str) -> Dict[str, List[Dict]]:
+            total_images += len(images)
+            page += 1
+
+        log.info(f"Indexed {len(index)} gallery folders from {total_images} images")
+        return index
+
+    def get_galleries_in_related_folders(self, scene_folder: str,
+                                         parent_path: Optional[str]) -> Dict[str, GalleryRecord]:
         """
-        Find images in:
-        1. Child/subfolders of scene_folder (e.g., /scene/pics/)
-        2. Direct parent folder only (e.g., /parent/ when scene is in /parent/video/)
+        Find folder-based galleries in:
+        1. The scene folder itself
+        2. Child/subfolders of scene_folder (e.g., /scene/pics/)
+        3. Direct parent folder only (e.g., /parent/ when scene is in /parent/video/)
 
-        Does NOT match sibling folders at the same level.
+        Returns a mapping of gallery folder path to gallery. Zip and manually
+        created galleries have no folder and are only found via images.
         """
-        # Query for images where path starts with parent_path
+        sep = re.escape(os.sep)
+        patterns = [f"{re.escape(scene_folder)}(?:{sep}.*)?"]
+        if parent_path and parent_path != scene_folder:
+            patterns.append(re.escape(parent_path))
+
         query = {
             "path": {
-                "modifier": "INCLUDES",
-                "value": parent_path
+                "modifier": "MATCHES_REGEX",
+                "value": f"^(?:{'|'.join(patterns)})$"
             }
         }
 
         try:
-            images = self.stash.find_images(
+            galleries = self.stash.find_galleries(
                 f=query,
-                filter={"per_page": -1},
-                fragment='id title visual_files { ... on ImageFile { path } } galleries { id title folder { path } }'
+                filter={"per_page": -1, "sort": "path", "direction": "ASC"},
+                fragment=GALLERY_FRAGMENT
             )
 
-            if not images:
-                return {}
+            folder_galleries = {}
+            for gallery in galleries or []:
+                gallery_folder = (gallery.get('folder') or {}).get('path', '')
+                if not gallery_folder:
+                    continue
 
-            # Group images by their folder path
-            folder_images = {}
-            for image in images:
-                # Images have visual_files array (union of VideoFile | ImageFile)
-                visual_files = image.get('visual_files', [])
-                if visual_files and len(visual_files) > 0:
-                    # Get path from the first file
-                    image_path = visual_files[0].get('path', '')
-                    if not image_path:
-                        continue
-
-                    image_folder = str(Path(image_path).parent)
-
-                    # Use the extracted matching logic function
-                    if not should_match_folder(image_folder, scene_folder, parent_path):
-                        # Skip siblings and other unrelated folders
-                        continue
-
-                    if image_folder not in folder_images:
-                        folder_images[image_folder] = []
-                    folder_images[image_folder].append(image)
-
-            return folder_images
+                if not should_match_folder(gallery_folder, scene_folder, parent_path):
+                    continue
+
+                if gallery_folder not in folder_galleries:
+                    folder_galleries[gallery_folder] = self.records.gallery(gallery)
+
+            return folder_galleries
         except Exception as e:
-            log.debug(f"Error finding images in related folders: {str(e)}")
+            log.debug(f"Error finding galleries in related folders: {str(e)}")
             return {}
 
-    def match_by_folder_hierarchy(self, scene: Dict) -> Optional[Dict]:
+    def log_match(self, scene: SceneRecord, match: FolderMatch, scene_folder: str):
+        """Log a scene -> gallery match."""
+        gallery = match.gallery
+
+        scene_name = self.get_scene_identifier(scene)
+        gallery_name = self.get_gallery_identifier(gallery)
+
+        log.info(f"Matched scene {scene.id} {scene_name} to gallery {gallery.id} {gallery_name} {match.via}")
+        log.debug(f"  Scene folder: {scene_folder}")
+        log.debug(f"  Gallery folder: {gallery.folder or 'No folder assigned'}")
+
+    def match_with_index(self, index: FolderGalleryIndex, scene_folder: str) -> Optional[FolderMatch]:
+        """Match a scene folder using a folder -> gallery index."""
+        return self.get_index_match(scene_folder, index.find_match(scene_folder))
+
+    def get_index_match(self, scene_folder: str,
+                        match: Optional[Tuple[str, Tuple[str, GalleryRecord]]]) -> Optional[FolderMatch]:
+        """Turn a FolderGalleryIndex.find_match result into a FolderMatch."""
+        if not match:
+            log.debug(f"No indexed gallery folder matches: {scene_folder}")
+            return None
+
+        folder_path, (image_id, gallery) = match
+        where = "same folder" if folder_path == scene_folder else f"related folder: {folder_path}"
+        return FolderMatch(self.records.shared_gallery(gallery), folder_path, f"via image {image_id} in {where}")
+
+    def match_images_in_same_folder(self, scene_folder: str) -> Optional[FolderMatch]:
+        """Step 1: use the gallery of the first image in the scene's own folder."""
+        first_image = self.get_first_image_in_folder(scene_folder)
+
+        if not first_image:
+            log.debug(f"No images found in same folder: {scene_folder}")
+            return None
+
+        entry = self.get_image_entry(first_image)
+        if not entry:
+            log.debug(f"First image {first_image.id} has no galleries")
+            return None
+
+        image_id, gallery = entry
+        return FolderMatch(gallery, scene_folder, f"via image {image_id} in same folder")
+
+    def match_images_in_related_folders(self, scene_folder: str, parent_path: Optional[str]) -> Optional[FolderMatch]:
+        """
+        Step 2: use the gallery of the first image in the direct parent, or
+        else in the first child folder (sorted by folder path) with one.
+        """
+        log.debug(f"Searching for images in direct parent {parent_path} and child folders")
+
+        entry = self.get_image_entry(self.get_first_image_in_folder(parent_path)) if parent_path else None
+        if entry:
+            folder_path = parent_path
+        else:
+            match = find_first_descendant(scene_folder, lambda before, skip: (
+                (image_path, self.get_image_entry(image))
+                for image_path, image in self.get_images_in_subfolders(scene_folder, before, skip)
+            ))
+            if not match:
+                log.debug(f"No images with galleries in related folders of {scene_folder}")
+                return None
+            folder_path, entry = match
+
+        image_id, gallery = entry
+        return FolderMatch(gallery, folder_path, f"via image {image_id} in related folder: {folder_path}")
+
+    def resolve_folder(self, scene_folder: str) -> Optional[FolderMatch]:
         """
-        Match scene to gallery using hierarchical folder-based approach:
+        Match a scene folder to a gallery using hierarchical folder-based approach:
         1. Search for images in the same folder as the scene
         2. If no images found, search in:
            - Child/subfolders of the scene folder (e.g., /scene/pics/)
            - Direct parent folder (e.g., /parent/ when scene is in /parent/video/)
         3. Return the gallery of the first image found
 
+        With the 'galleries' strategy, folder-based galleries are looked up
+        directly at each step and images are only searched when a folder has
+        no folder-based gallery.
+
+        Results are cached per folder, so every scene in a folder shares one
+        lookup, and in the persistent cache across runs if enabled.
+
         NOTE: Does NOT match sibling folders at the same level.
         Example: Scene in /media/2024/april/ will NOT match /media/2024/march/ (siblings)
         But: Scene in /media/session/video/ WILL match /media/session/ (direct parent)
         """
-        scene_files = scene.get('files', [])
-        if not scene_files:
-            log.debug(f"Scene {scene['id']} has no files")
-            return None
-
-        scene_path = scene_files[0]['path']
-        scene_folder = str(Path(scene_path).parent)
-
-        log.debug(f"Scene {scene['id']} folder: {scene_folder}")
-
-        # Step 1: Search for images in the same folder
-        images = self.get_images_in_folder(scene_folder)
-
-        if images:
-            log.debug(f"Found {len(images)} images in same folder: {scene_folder}")
-            # Get the first image's gallery
-            first_image = images[0]
-            galleries = first_image.get('galleries', [])
-
-            if galleries:
-                gallery = galleries[0]  # Use first gallery
-                gallery_folder = gallery.get('folder', {}).get('path', 'No folder assigned')
-
-                scene_name = self.get_scene_identifier(scene)
-                gallery_name = self.get_gallery_identifier(gallery)
-
-                log.info(f"Matched scene {scene['id']} {scene_name} to gallery {gallery['id']} {gallery_name} "
-                        f"via image {first_image['id']} in same folder")
-                log.debug(f"  Scene folder: {scene_folder}")
-                log.debug(f"  Gallery folder: {gallery_folder}")
-                return gallery
+        with self.lock:
+            if scene_folder in self.folder_matches:
+                return self.folder_matches[scene_folder]
+
+        # The cache is shared by every scope, so results that depend on
+        # pathPrefix cutting off the parent are neither read nor stored
+        if self.cache is not None and not self.parent_out_of_scope(scene_folder):
+            hit, value = self.cache_get(scene_folder)
+            if hit:
+                self.increment_stat('cache_hits')
+                match = None
+                if value:
+                    gallery, folder, via = value
+                    match = FolderMatch(self.records.gallery(gallery), folder, via)
             else:
-                log.debug(f"First image {first_image['id']} has no galleries")
+                match = self._resolve_folder(scene_folder)
+                self.cache_put(scene_folder, match)
         else:
-            log.debug(f"No images found in same folder: {scene_folder}")
+            match = self._resolve_folder(scene_folder)
+
+        with self.lock:
+            if scene_folder not in self.folder_matches:
+                self.folder_matches[scene_folder] = match
+                self.stats['folders'] += 1
+        return match
+
+    def _resolve_folder(self, scene_folder: str) -> Optional[FolderMatch]:
+        if self.gallery_index is not None:
+            return self.match_with_index(self.gallery_index, scene_folder)
+
+        parent_path = self.records.folders.parent_path(scene_folder)
+        has_parent = bool(parent_path) and parent_path != scene_folder
+        if self.parent_out_of_scope(scene_folder):
+            # Lookups stay inside pathPrefix; child folders are still searched
+            parent_path = None
+        by_gallery_folder = self.settings.get('matchStrategy') == 'galleries'
+
+        folder_galleries = {}
+        if by_gallery_folder:
+            folder_galleries = self.get_galleries_in_related_folders(scene_folder, parent_path)
+            if scene_folder in folder_galleries:
+                return FolderMatch(folder_galleries[scene_folder], scene_folder, "via folder gallery in same folder")
+
+        # Step 1: Search for images in the same folder
+        match = self.match_images_in_same_folder(scene_folder)
+        if match:
+            return match
 
         # Step 2: Search in related folders:
         # - Child/subfolders of scene folder (e.g., /scene/pics/)
         # - Direct parent folder (e.g., /parent/ when scene is in /parent/video/)
         # Does NOT search sibling folders (e.g., /parent/other/ when scene is in /parent/video/)
-        parent_path = str(Path(scene_folder).parent)
-
-        if not parent_path or parent_path == scene_folder:
-            log.debug(f"No valid parent path for scene {scene['id']}")
+        if not has_parent:
+            log.debug(f"No valid parent path for folder {scene_folder}")
             return None
 
-        log.debug(f"Searching for images in child folders and direct parent: {parent_path}")
+        if folder_galleries:
+            folder_path = sorted(folder_galleries.keys())[0]
+            return FolderMatch(folder_galleries[folder_path], folder_path,
+                               f"via folder gallery in related folder: {folder_path}")
 
-        folder_images = self.get_images_in_parent_folders(parent_path, scene_folder)
+        return self.match_images_in_related_folders(scene_folder, parent_path)
 
-        if folder_images:
-            log.debug(f"Found images in {len(folder_images)} related folders")
+    def get_scene_folder(self, scene: SceneRecord) -> Optional[str]:
+        """Get the folder containing the scene's first file."""
+        return self.records.folder_path(scene.folder_id)
 
-            # Sort folders by path for consistent ordering
-            for folder_path in sorted(folder_images.keys()):
-                images_in_folder = folder_images[folder_path]
-                log.debug(f"  {folder_path}: {len(images_in_folder)} images")
-
-                # Get first image's gallery from this folder
-                first_image = images_in_folder[0]
-                galleries = first_image.get('galleries', [])
-
-                if galleries:
-                    gallery = galleries[0]
-                    gallery_folder = gallery.get('folder', {}).get('path', 'No folder assigned')
+    def match_by_folder_hierarchy(self, scene: SceneRecord) -> Optional[GalleryRecord]:
+        """Match a scene to a gallery by its folder. See resolve_folder."""
+        scene_folder = self.get_scene_folder(scene)
+        if scene_folder is None:
+            log.debug(f"Scene {scene.id} has no files")
+            return None
 
-                    scene_name = self.get_scene_identifier(scene)
-                    gallery_name = self.get_gallery_identifier(gallery)
-
-                    log.info(f"Matched scene {scene['id']} {scene_name} to gallery {gallery['id']} {gallery_name} "
-                            f"via image {first_image['id']} in related folder: {folder_path}")
-                    log.debug(f"  Scene folder: {scene_folder}")
-                    log.debug(f"  Gallery folder: {gallery_folder}")
-                    return gallery
-                else:
-                    log.debug(f"  First image {first_image['id']} in {folder_path} has no galleries")
-        else:
-            log.debug(f"No related folders with images found for: {scene_folder}")
+        log.debug(f"Scene {scene.id} folder: {scene_folder}")
 
+        match = self.resolve_folder(scene_folder)
+        if match:
+            self.log_match(scene, match, scene_folder)
+            return match.gallery
         return None
 
-    def assign_scene_to_gallery(self, scene: Dict, gallery: Dict):
-        """Assign a scene to a gallery."""
+    def assign_scene_to_gallery(self, scene: SceneRecord, gallery: GalleryRecord):
+        """
+        Assign a scene to a gallery.
+
+        Assignments are queued per gallery. Once assignBatchSize scenes are
+        waiting in all, the whole queue is sent, one bulk update_scenes
+        mutation per gallery (see flush_assignments), so the queue stays
+        small and assignments are sent soon after they are logged.
+        """
         dry_run = self.settings.get('dryRun', False)
 
         scene_name = self.get_scene_identifier(scene)
         gallery_name = self.get_gallery_identifier(gallery)
 
-        log.info(f"{'[DRY RUN] ' if dry_run else ''}Assigning scene {scene['id']} {scene_name} to gallery {gallery['id']} {gallery_name}")
+        log.info(f"{'[DRY RUN] ' if dry_run else ''}Assigning scene {scene.id} {scene_name} to gallery {gallery.id} {gallery_name}")
 
-        if not dry_run:
-            try:
-                # Update the scene to add the gallery
-                self.stash.update_scenes({
-                    "ids": [scene['id']],
-                    "gallery_ids": {
-                        "mode": "ADD",
-                        "ids": [gallery['id']]
-                    }
-                })
-                self.stats['assigned'] += 1
-            except Exception as e:
-                scene_name = self.get_scene_identifier(scene)
-                gallery_name = self.get_gallery_identifier(gallery)
-                log.error(f"Error assigning scene {scene['id']} {scene_name} to gallery {gallery['id']} {gallery_name}: {str(e)}")
-                self.stats['errors'] += 1
-        else:
-            self.stats['assigned'] += 1
+        if dry_run:
+            self.increment_stat('assigned')
+            return
+
+        _, scenes = self.pending_assignments.setdefault(gallery.id, (gallery, []))
+        scenes.append(scene)
+        self.pending_count += 1
+
+        batch_size = int(self.settings.get('assignBatchSize') or 100)
+        if self.pending_count >= batch_size:
+            self.flush_assignments()
+
+    def flush_gallery_assignments(self, gallery_id: str):
+        """Send the queued assignments for one gallery."""
+        gallery, scenes = self.pending_assignments.pop(gallery_id, (None, []))
+        self.pending_count -= len(scenes)
+        if scenes:
+            self.update_scene_galleries(scenes, gallery)
+
+    def flush_assignments(self):
+        """Send all queued assignments."""
+        for gallery_id in list(self.pending_assignments):
+            self.flush_gallery_assignments(gallery_id)
+
+    def update_scene_galleries(self, scenes: List[SceneRecord], gallery: GalleryRecord):
+        """
+        Add a gallery to scenes with one bulk mutation.
 
-    def process_scene(self, scene: Dict):
-        """Process a single orphan scene and try to assign it to a gallery."""
-        # Use hierarchical folder-based matching
-        matched_gallery = self.match_by_folder_hierarchy(scene)
+        If the mutation fails the batch is split in half and retried, so a
+        single bad scene only fails on its own.
+        """
+        try:
+            # Update the scenes to add the gallery
+            self.stash.update_scenes({
+                "ids": [scene.id for scene in scenes],
+                "gallery_ids": {
+                    "mode": "ADD",
+                    "ids": [gallery.id]
+                }
+            })
+            self.increment_stat('assigned', len(scenes))
+        except Exception as e:
+            if len(scenes) > 1:
+                log.warning(f"Error assigning {len(scenes)} scenes to gallery {gallery.id}, "
+                            f"retrying in smaller batches: {str(e)}")
+                middle = len(scenes) // 2
+                self.update_scene_galleries(scenes[:middle], gallery)
+                self.update_scene_galleries(scenes[middle:], gallery)
+                return
+
+            scene = scenes[0]
+            scene_folder = self.get_scene_folder(scene)
+            if scene_folder is not None:
+                with self.lock:
+                    self.unmatched_folders.add(scene_folder)
 
-        # Assign if we found a match
-        if matched_gallery:
-            self.assign_scene_to_gallery(scene, matched_gallery)
+            scene_name = self.get_scene_identifier(scene)
+            gallery_name = self.get_gallery_identifier(gallery)
+            log.error(f"Error assigning scene {scene.id} {scene_name} to gallery {gallery.id} {gallery_name}: {str(e)}")
+            self.increment_stat('errors')
+
+    def apply_match(self, scene: SceneRecord, scene_folder: Optional[str], match: Optional[FolderMatch]):
+        """Assign a scene to its matched gallery, or count it as skipped."""
+        if match:
+            self.log_match(scene, match, scene_folder)
+            if self.plan is not None:
+                self.plan_assignment(scene, scene_folder, match)
+            else:
+                self.assign_scene_to_gallery(scene, match.gallery)
         else:
             scene_name = self.get_scene_identifier(scene)
-            log.debug(f"No matching gallery found for scene {scene['id']} {scene_name}")
-            self.stats['skipped'] += 1
+            log.debug(f"No matching gallery found for scene {scene.id} {scene_name}")
+            self.increment_stat('skipped')
+
+    def plan_assignment(self, scene: SceneRecord, scene_folder: str, match: FolderMatch):
+        """Add a matched scene to the plan instead of assigning it."""
+        gallery = match.gallery
+        self.plan.append(PlanEntry(
+            scene.id, scene.title, scene_folder, gallery.id, gallery.title, gallery.folder or '',
+            match.folder, match_reason(scene_folder, match.folder), match.via
+        ))
+        self.increment_stat('assigned')
+
+    def group_scenes_by_folder(self, scenes: List[SceneRecord]) -> Dict[Optional[str], List[SceneRecord]]:
+        """Group scenes by folder, keeping the order in which folders first appear."""
+        groups = {}
+        for scene in scenes:
+            groups.setdefault(self.get_scene_folder(scene), []).append(scene)
+        return groups
+
+    def resolve_folders(self, folders: List[Optional[str]],
+                        executor: Optional[ThreadPoolExecutor] = None) -> List[Optional[FolderMatch]]:
+        """
+        Resolve a list of scene folders, on the executor's worker threads if given.
 
-    def process_all(self):
-        """Main processing function."""
-        log.info("Starting orphan scene processing...")
-        log.info(f"Settings: {self.settings}")
+        Results are returned in the same order as folders regardless of which
+        worker finishes first.
+        """
+        if self.match_pool is not None:
+            return self.resolve_folders_in_pool(folders)
 
-        # Fetch orphan scenes
-        orphan_scenes = self.get_orphan_scenes()
+        def resolve(scene_folder: Optional[str]) -> Optional[FolderMatch]:
+            return self.resolve_folder(scene_folder) if scene_folder is not None else None
 
-        if not orphan_scenes:
-            log.info("No orphan scenes found!")
-            return
+        if executor is None:
+            return [resolve(scene_folder) for scene_folder in folders]
+        return list(executor.map(resolve, folders))
+
+    def resolve_folders_in_pool(self, folders: List[Optional[str]]) -> List[Optional[FolderMatch]]:
+        """
+        Resolve scene folders against the prefetch index on the worker
+        processes, then record the results on this thread in folder order.
+        """
+        new_folders = [folder for folder in dict.fromkeys(folders)
+                       if folder is not None and folder not in self.folder_matches]
+        for scene_folder, match in zip(new_folders, self.match_pool.find_matches(new_folders)):
+            self.folder_matches[scene_folder] = self.get_index_match(scene_folder, match)
+            self.stats['folders'] += 1
+        return [self.folder_matches[folder] if folder is not None else None for folder in folders]
+
+    def apply_folder_match(self, scene_folder: Optional[str], scenes: List[SceneRecord], match: Optional[FolderMatch]):
+        """Apply a folder's resolved gallery to every scene in it."""
+        if scene_folder is None:
+            log.debug(f"Scenes {', '.join(scene.id for scene in scenes)} have no files")
+        else:
+            log.debug(f"Folder {scene_folder}: {len(scenes)} orphan scenes")
+            if match is None:
+                self.unmatched_folders.add(scene_folder)
+
+        for scene in scenes:
+            self.apply_match(scene, scene_folder, match)
+
+    def process_folder(self, scene_folder: Optional[str], scenes: List[SceneRecord]):
+        """Resolve a folder once and apply the result to every scene in it."""
+        match, = self.resolve_folders([scene_folder])
+        self.apply_folder_match(scene_folder, scenes, match)
+
+    def get_deadline(self) -> Optional[float]:
+        """perf_counter time at which maxRuntimeMinutes runs out, or None for no limit."""
+        minutes = float(self.settings.get('maxRuntimeMinutes') or 0)
+        return self.metrics.started + minutes * 60 if minutes > 0 else None
+
+    def get_folder_cost(self, scene_folder: Optional[str]) -> int:
+        """0 if a folder can be resolved without querying Stash, otherwise 1."""
+        if scene_folder is None or self.gallery_index is not None:
+            return 0
+        with self.lock:
+            return 0 if scene_folder in self.folder_matches else 1
+
+    def run_matching(self, pages: Iterable[List[SceneRecord]], total: int, processed: int = 0,
+                     after_id: int = 0, done_ids: Optional[Set[str]] = None) -> int:
+        """
+        Match and assign pages of orphan scenes.
 
-        # Process each orphan scene
-        log.info(f"Processing {len(orphan_scenes)} orphan scenes using folder hierarchy matching...")
+        With maxRuntimeMinutes set, folders that need no Stash query are
+        matched first within each page, and the run stops between folders
+        once the time is up. Where it stopped is checkpointed for resuming.
 
-        for i, scene in enumerate(orphan_scenes):
-            log.progress((i + 1) / len(orphan_scenes))
-            self.process_scene(scene)
+        Args:
+            pages: Pages of orphan scenes, in id order when checkpointing
+            total: Number of scenes expected, for progress
+            processed: Scenes already processed by the run being resumed
+            after_id: Last scene id of the last page the resumed run completed
+            done_ids: Scenes after after_id that the resumed run already processed
 
-        # Print summary
+        Returns:
+            Number of scenes processed
+        """
+        if self.settings.get('matchStrategy', 'query') == 'prefetch':
+            with self.metrics.phase('index'):
+                self.gallery_index = self.build_gallery_index()
+
+            # Matching against the index is pure CPU work, so it can use more
+            # cores. Processes are started before the matching threads; they
+            # share the index unless other threads already run (see IndexMatchPool)
+            processes = int(self.settings.get('matchProcesses') or 1)
+            if processes > 1:
+                self.match_pool = IndexMatchPool(self.gallery_index, processes)
+                log.info(f"Matching folders on {processes} processes ({self.match_pool.start_method})")
+        elif self.settings.get('persistentCache', False):
+            try:
+                self.cache = self.open_cache()
+            except sqlite3.OperationalError as e:
+                log.warning(f"Folder cache unavailable, matching without it: {str(e)}")
+
+        # Process each orphan scene as pages arrive
+        log.info(f"Processing {total} orphan scenes using folder hierarchy matching...")
+
+        # Folder lookups run on a worker pool; the number of workers bounds
+        # the number of GraphQL requests in flight
+        concurrency = int(self.settings.get('concurrency') or 1)
+        executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+        if executor:
+            log.info(f"Matching folders with {concurrency} concurrent workers")
+
+        checkpoint_pages = int(self.settings.get('checkpointPages') or 0)
+        pages_since_checkpoint = 0
+        deadline = self.get_deadline()
+        page_done_ids: List[str] = []
+        pages = iter(pages)
+        try:
+            while True:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    self.out_of_time = True
+                    break
+
+                with self.metrics.phase('fetch'):
+                    scenes = next(pages, None)
+                if scenes is None:
+                    break
+
+                # Scenes from the same shoot usually share a folder, so resolve
+                # each distinct folder once for the whole page
+                with self.metrics.phase('match'):
+                    groups = self.group_scenes_by_folder(
+                        [scene for scene in scenes if not done_ids or scene.id not in done_ids]
+                    )
+                    folders = list(groups)
+                    if deadline is not None:
+                        # Cheapest first, so the time budget buys the most assignments
+                        folders.sort(key=self.get_folder_cost)
+
+                # Without a time limit the whole page is matched at once; with
+                # one, a worker pool's worth of folders at a time
+                chunk_size = concurrency if deadline is not None else max(len(folders), 1)
+                for i in range(0, len(folders), chunk_size):
+                    if deadline is not None and time.perf_counter() >= deadline:
+                        self.out_of_time = True
+                        break
+
+                    chunk = folders[i:i + chunk_size]
+                    with self.metrics.phase('match'):
+                        matches = self.resolve_folders(chunk, executor)
+
+                    # Assign in page order on this thread, so logs and results do
+                    # not depend on the number of workers
+                    with self.metrics.phase('assign'):
+                        for scene_folder, match in zip(chunk, matches):
+                            folder_scenes = groups[scene_folder]
+                            self.apply_folder_match(scene_folder, folder_scenes, match)
+                            page_done_ids.extend(scene.id for scene in folder_scenes)
+
+                            # New scenes may be created while running, so cap progress at 100%
+                            processed += len(folder_scenes)
+                            log.progress(min(processed / total, 1.0))
+
+                if self.out_of_time:
+                    break
+
+                after_id = int(scenes[-1].id)
+                page_done_ids = []
+                done_ids = None
+                pages_since_checkpoint += 1
+                if self.checkpoint_run is not None and checkpoint_pages and pages_since_checkpoint >= checkpoint_pages:
+                    self.save_checkpoint(after_id, processed)
+                    pages_since_checkpoint = 0
+        finally:
+            if executor:
+                executor.shutdown()
+            if self.match_pool is not None:
+                self.match_pool.close()
+                self.match_pool = None
+            with self.metrics.phase('assign'):
+                self.flush_assignments()
+            if self.cache is not None:
+                self.cache.close()
+
+        if self.out_of_time:
+            self.stats['remaining'] = max(total - processed, 0)
+            log.warning(f"Stopped after {self.settings.get('maxRuntimeMinutes')} minutes with "
+                        f"{self.stats['remaining']} orphan scenes left unprocessed")
+            if self.checkpoint_run is not None:
+                self.save_checkpoint(after_id, processed, sorted(set(page_done_ids) | (done_ids or set())))
+                log.info("Run 'Resume Assign Orphan Scenes to Galleries' to continue where this run stopped")
+
+        return processed
+
+    def log_summary(self, processed: int):
+        """Print the end-of-run summary."""
         log.info("=" * 50)
-        log.info("Processing complete!")
-        log.info(f"Total orphan scenes: {self.stats['total_orphans']}")
+        log.info("Stopped: time limit reached" if self.out_of_time else "Processing complete!")
+        if self.path_prefix or self.shard:
+            log.info(f"Scope: {self.get_scope_name()}")
+        # A shard only knows how many scenes it has once it saw them all
+        estimate = self.get_estimate_label() if self.out_of_time else ''
+        log.info(f"Total orphan scenes: {estimate}{self.stats['total_orphans']}")
         log.info(f"Assigned: {self.stats['assigned']}")
         log.info(f"Skipped: {self.stats['skipped']}")
         log.info(f"Errors: {self.stats['errors']}")
+        if self.out_of_time:
+            log.info(f"Left unprocessed: {estimate}{self.stats['remaining']}")
+        log.info(f"Distinct folders: {self.stats['folders']} for {processed} scenes")
+        if self.cache is not None:
+            log.info(f"Folder cache hits: {self.stats['cache_hits']}")
+        for line in self.metrics.summary_lines():
+            log.info(line)
         log.info("=" * 50)
+        self.write_metrics_report()
+
+    def write_metrics_report(self):
+        """Append this run's metrics to the JSON lines report, if configured."""
+        path = self.settings.get('metricsReportPath')
+        if not path:
+            return
+
+        path = os.path.join(PLUGIN_DIR, path)  # Relative paths are in the plugin directory
+        try:
+            self.metrics.write_report(path, {
+                'finished_at': utc_timestamp(),
+                'match_strategy': self.settings.get('matchStrategy', 'query'),
+                'concurrency': int(self.settings.get('concurrency') or 1),
+                'dry_run': self.settings.get('dryRun', False),
+                'path_prefix': self.path_prefix,
+                'shard': self.settings.get('shard') or None,
+                'stats': self.stats
+            })
+            log.debug(f"Appended run metrics to {path}")
+        except OSError as e:
+            log.warning(f"Could not write metrics report {path}: {str(e)}")
+
+    def get_state_path(self) -> str:
+        return self.scoped_path(self.settings.get('statePath') or os.path.join(PLUGIN_DIR, 'run_state.json'))
+
+    def load_run_state(self) -> Optional[Dict]:
+        """Load the state recorded by the last successful run, if any."""
+        try:
+            with open(self.get_state_path(), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable run state {self.get_state_path()}: {str(e)}")
+            return None
+
+    def save_run_state(self, run_started: str, unmatched_folders: Set[str]):
+        """
+        Record the high-water mark for incremental runs, along with the
+        folders whose scenes are still orphaned.
+        """
+        if self.settings.get('dryRun', False):
+            log.debug("Dry run - not recording run state")
+            return
+
+        state = {
+            'last_run': run_started,
+            'unmatched_folders': sorted(unmatched_folders)
+        }
+        with open(self.get_state_path(), 'w') as f:
+            json.dump(state, f)
+
+    def get_plan_path(self) -> str:
+        """Plan file of this scope, relative to the plugin directory unless absolute."""
+        return self.scoped_path(os.path.join(PLUGIN_DIR, self.settings.get('planPath') or 'match_plan.json'))
+
+    def get_checkpoint_path(self) -> str:
+        return self.scoped_path(self.settings.get('checkpointPath') or os.path.join(PLUGIN_DIR, 'checkpoint.json'))
+
+    def save_checkpoint(self, last_scene_id: int, processed: int, done_ids: Optional[List[str]] = None):
+        """
+        Record the progress of a full run, so it can be resumed after the
+        last page that was completely processed, skipping done_ids: scenes of
+        the next page that were processed before the run stopped.
+
+        Assignments still queued for batching are saved with it rather than
+        flushed, so checkpoints do not change how mutations are batched.
+        """
+        checkpoint = {
+            'run_started': self.checkpoint_run,
+            'dry_run': self.settings.get('dryRun', False),
+            'last_scene_id': last_scene_id,
+            'processed': processed,
+            'done_ids': done_ids or [],
+            'stats': self.stats,
+            'pending_assignments': [
+                [gallery.to_graphql(), [[scene.id, scene.title] for scene in scenes]]
+                for gallery, scenes in self.pending_assignments.values()
+            ],
+            'unmatched_folders': sorted(self.unmatched_folders)
+        }
+        path = self.get_checkpoint_path()
+        try:
+            # Write then rename, so a run killed mid-write keeps the previous checkpoint
+            with self.lock:
+                data = json.dumps(checkpoint)
+            with open(path + '.tmp', 'w') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            log.debug(f"Checkpoint: {processed} scenes processed, up to scene {last_scene_id}")
+        except OSError as e:
+            log.warning(f"Could not write checkpoint {path}: {str(e)}")
+
+    def load_checkpoint(self) -> Optional[Dict]:
+        """Load the checkpoint of an unfinished full run, if any."""
+        try:
+            with open(self.get_checkpoint_path(), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable checkpoint {self.get_checkpoint_path()}: {str(e)}")
+            return None
+
+    def clear_checkpoint(self):
+        try:
+            os.remove(self.get_checkpoint_path())
+        except FileNotFoundError:
+            pass
+
+    def restore_checkpoint(self, checkpoint: Dict):
+        """Restore the stats, queued assignments and unmatched folders of a checkpoint."""
+        self.stats.update(checkpoint['stats'])
+        self.stats['remaining'] = 0
+        self.unmatched_folders = set(checkpoint['unmatched_folders'])
+        for gallery, scenes in checkpoint['pending_assignments']:
+            gallery = self.records.gallery(gallery)
+            # Queued scenes only need an id to be assigned and a title to be logged
+            self.pending_assignments[gallery.id] = (
+                gallery, [SceneRecord(scene_id, title, None, None) for scene_id, title in scenes]
+            )
+            self.pending_count += len(scenes)
+
+    def find_folders_near_new_galleries(self, timestamp: str, folders: Set[str]) -> Set[str]:
+        """
+        Find which of the given scene folders could match a gallery created
+        or updated after timestamp.
+        """
+        if not folders:
+            return set()
+
+        gallery_folders = filter(None, (self.get_gallery_folder(gallery)
+                                        for gallery in self.get_galleries_updated_since(timestamp)))
+        matches = match_folders_batch(folders, gallery_folders)
+        return {folder for folder, related in matches.items() if related.all()}
+
+    def process_new_scene(self, scene_id: str):
+        """
+        Match and assign a single newly created scene.
+
+        Used by the Scene.Create.Post hook, so it avoids any library-wide
+        fetch: one query for the scene, the folder lookups and one mutation.
+        The prefetch strategy falls back to per-folder queries here.
+        """
+        scene = self.stash.find_scene(
+            scene_id,
+            fragment='id title organized files { path } galleries { id }'
+        )
+        if not scene:
+            log.debug(f"Scene {scene_id} not found")
+            return
+
+        if scene.get('galleries'):
+            log.debug(f"Scene {scene_id} already has galleries")
+            return
+
+        if self.settings.get('excludeOrganized', False) and scene.get('organized', False):
+            log.debug(f"Skipping organized scene {scene_id}")
+            return
+
+        scene = self.records.scene(scene)
+        gallery = self.match_by_folder_hierarchy(scene)
+        if gallery:
+            self.assign_scene_to_gallery(scene, gallery)
+            self.flush_assignments()
+        else:
+            scene_name = self.get_scene_identifier(scene)
+            log.debug(f"No matching gallery found for scene {scene.id} {scene_name}")
+
+    def process_new_gallery(self, gallery_id: str):
+        """
+        Attach orphan scenes to a newly created gallery.
+
+        Used by the Gallery.Create.Post hook. Instead of rescanning the
+        library, a single find_scenes query finds the orphan scenes whose
+        folders the gallery's folder matches (the inverse of
+        should_match_folder), and they are assigned together.
+        """
+        gallery = self.stash.find_gallery(gallery_id, fragment='id title folder { path } files { path }')
+        if not gallery:
+            log.debug(f"Gallery {gallery_id} not found")
+            return
+
+        gallery_folder = self.get_gallery_folder(gallery)
+        if not gallery_folder:
+            log.debug(f"Gallery {gallery_id} has no folder or zip file")
+            return
+
+        scenes = []
+        for page in self.get_orphan_scene_pages(self.get_gallery_scene_filter(gallery_folder)):
+            for scene in page:
+                scene_folder = self.get_scene_folder(scene)
+                if scene_folder is None:
+                    continue
+                if should_match_folder(gallery_folder, scene_folder, self.records.folders.parent_path(scene_folder)):
+                    scenes.append(scene)
+
+        if not scenes:
+            log.debug(f"No orphan scenes near gallery {gallery_id} folder {gallery_folder}")
+            return
+
+        gallery = self.records.gallery(gallery)
+        gallery_name = self.get_gallery_identifier(gallery)
+        log.info(f"Found {len(scenes)} orphan scenes for new gallery {gallery.id} {gallery_name}")
+
+        for scene in scenes:
+            self.assign_scene_to_gallery(scene, gallery)
+        self.flush_assignments()
+
+    def process_hook(self, hook_context: Dict):
+        """Handle a hook event from Stash."""
+        hook_type = hook_context.get('type')
+
+        if not self.settings.get('enableHooks', False):
+            log.debug(f"Ignoring {hook_type} hook - automatic assignment is disabled")
+            return
+
+        if hook_type == 'Scene.Create.Post':
+            self.process_new_scene(str(hook_context['id']))
+        elif hook_type == 'Gallery.Create.Post':
+            self.process_new_gallery(str(hook_context['id']))
+        else:
+            log.debug(f"Unhandled hook: {hook_type}")
+
+    def process_all(self, checkpoint: Optional[Dict] = None):
+        """
+        Main processing function.
+
+        Progress is checkpointed every checkpointPages pages. Given a
+        checkpoint, continues that run after its last processed scene.
+        """
+        log.info(f"Starting orphan scene processing ({self.get_scope_name()})...")
+        log.info(f"Settings: {self.settings}")
+
+        run_started = utc_timestamp()
+        after_id = processed = 0
+        done_ids = set()
+        if checkpoint:
+            run_started = checkpoint['run_started']
+            after_id = checkpoint['last_scene_id']
+            processed = checkpoint['processed']
+            done_ids = set(checkpoint.get('done_ids', []))
+            self.restore_checkpoint(checkpoint)
+            log.info(f"Resuming run started {run_started} after scene {after_id}, "
+                     f"{processed} scenes already processed")
+        self.checkpoint_run = run_started
+
+        # Count orphan scenes
+        with self.metrics.phase('fetch'):
+            scene_count = self.count_orphan_scenes({"id": {"value": after_id, "modifier": "GREATER_THAN"}})
+        remaining = self.get_shard_share(scene_count)
+        total_orphans = processed + remaining
+        self.stats['total_orphans'] = total_orphans
+        log.info(f"Found {self.get_estimate_label()}{remaining} orphan scenes"
+                 f"{' left to process' if checkpoint else ''}")
+
+        if not remaining:
+            if not processed:
+                log.info("No orphan scenes found!")
+            with self.metrics.phase('assign'):
+                self.flush_assignments()
+            self.save_run_state(run_started, self.unmatched_folders)
+            self.clear_checkpoint()
+            if processed:
+                self.log_summary(processed)
+            return
+
+        processed = self.run_matching(self.get_orphan_scene_pages(after_id=after_id, count=scene_count),
+                                      total_orphans, processed, after_id, done_ids)
+        if not self.out_of_time:
+            self.stats['total_orphans'] = processed
+            self.save_run_state(run_started, self.unmatched_folders)
+            self.clear_checkpoint()
+        self.log_summary(processed)
+
+    def process_resume(self):
+        """Continue the last full run from its checkpoint, or start a new one."""
+        checkpoint = self.load_checkpoint()
+        if not checkpoint:
+            log.info("No checkpoint found, processing the whole library")
+        elif checkpoint.get('dry_run', False) != self.settings.get('dryRun', False):
+            log.warning("Checkpoint was made with a different Dry Run setting, processing the whole library")
+            checkpoint = None
+        self.process_all(checkpoint)
+
+    def process_plan(self):
+        """
+        Match every orphan scene and write the proposed assignments to the
+        plan file instead of assigning them. Nothing is changed in Stash and
+        no run state or checkpoint is recorded.
+        """
+        log.info(f"Planning orphan scene assignments ({self.get_scope_name()})...")
+        log.info(f"Settings: {self.settings}")
+
+        created = utc_timestamp()
+        self.plan = []
+
+        with self.metrics.phase('fetch'):
+            scene_count = self.count_orphan_scenes()
+        total = self.get_shard_share(scene_count)
+        self.stats['total_orphans'] = total
+        log.info(f"Found {self.get_estimate_label()}{total} orphan scenes")
+
+        processed = self.run_matching(self.get_orphan_scene_pages(count=scene_count), total) if total else 0
+        if not self.out_of_time:
+            self.stats['total_orphans'] = processed
+
+        path = self.get_plan_path()
+        write_plan(path, self.plan, created, self.get_scope_name())
+        log.info(f"Wrote {len(self.plan)} planned assignments to {path}")
+        if self.out_of_time:
+            log.warning("The plan only covers the scenes matched before the time limit")
+        self.log_summary(processed)
+
+    def process_apply_plan(self):
+        """
+        Assign the scenes in the plan file to their planned galleries with
+        batched update_scenes mutations, without matching or looking
+        anything up. Honours dryRun and assignBatchSize.
+        """
+        path = self.get_plan_path()
+        log.info(f"Applying plan {path}...")
+        try:
+            entries = read_plan(path)
+        except FileNotFoundError:
+            log.error(f"No plan found at {path}, run 'Plan Orphan Scene Assignments' first")
+            return
+        except (OSError, ValueError, KeyError) as e:
+            log.error(f"Could not read plan {path}: {str(e)}")
+            return
+
+        self.stats['total_orphans'] = len(entries)
+        log.info(f"Plan has {len(entries)} assignments")
+
+        with self.metrics.phase('assign'):
+            for processed, entry in enumerate(entries, 1):
+                gallery = self.records.gallery({
+                    'id': entry.gallery_id,
+                    'title': entry.gallery_title,
+                    'folder': {'path': entry.gallery_folder}
+                })
+                # Assignments only need a scene id, and a title to be logged
+                self.assign_scene_to_gallery(SceneRecord(entry.scene_id, entry.scene_title, None, None), gallery)
+                log.progress(processed / len(entries))
+            self.flush_assignments()
+
+        self.log_summary(len(entries))
+
+    def process_incremental(self):
+        """
+        Process only orphan scenes created or updated since the last
+        successful run, plus orphans left unmatched by earlier runs whose
+        folders are near a gallery created or updated since then.
+        """
+        log.info(f"Starting incremental orphan scene processing ({self.get_scope_name()})...")
+        log.info(f"Settings: {self.settings}")
+
+        state = self.load_run_state()
+        if not state:
+            log.info("No previous run recorded, processing the whole library")
+            self.process_all()
+            return
+
+        run_started = utc_timestamp()
+        last_run = state['last_run']
+        previous_unmatched = set(state.get('unmatched_folders', []))
+        log.info(f"Looking for changes since {last_run}")
+
+        # Orphan scenes created or updated since the last run
+        scene_filters = [{"updated_at": {"value": last_run, "modifier": "GREATER_THAN"}}]
+
+        # Orphans left over from earlier runs, only where a gallery appeared nearby
+        with self.metrics.phase('fetch'):
+            retry_folders = self.find_folders_near_new_galleries(last_run, previous_unmatched)
+            retry_folders = sorted(retry_folders)
+            for i in range(0, len(retry_folders), 100):
+                scene_filters.append(self.get_folder_scene_filter(retry_folders[i:i + 100]))
+
+            scene_counts = [self.count_orphan_scenes(scene_filter) for scene_filter in scene_filters]
+        total = sum(self.get_shard_share(count) for count in scene_counts)
+        self.stats['total_orphans'] = total
+        log.info(f"Found {total} orphan scenes to check, including "
+                 f"{len(retry_folders)} previously unmatched folders near new galleries")
+
+        def unique_pages() -> Iterator[List[SceneRecord]]:
+            # A scene can be both recently updated and in a retried folder
+            seen = set()
+            for scene_filter, count in zip(scene_filters, scene_counts):
+                for scenes in self.get_orphan_scene_pages(scene_filter, count=count):
+                    scenes = [scene for scene in scenes if scene.id not in seen]
+                    seen.update(scene.id for scene in scenes)
+                    if scenes:
+                        yield scenes
+
+        processed = self.run_matching(unique_pages(), total) if total else 0
+
+        # A run that ran out of time keeps the previous high-water mark, so
+        # the next run checks the scenes it did not get to
+        if not self.out_of_time:
+            matched_folders = {folder for folder, match in self.folder_matches.items() if match}
+            self.save_run_state(run_started, (previous_unmatched - matched_folders) | self.unmatched_folders)
+        self.log_summary(processed)
 
 
 def main():
@@ -365,27 +1480,53 @@ def main():
     # Get plugin configuration
     config = stash.get_configuration()
 
-    # Default settings
-    settings = {
-        "excludeOrganized": False,
-        "dryRun": False
-    }
-
-    # Override with user settings
+    # Default settings, overridden with user settings
+    settings = dict(DEFAULT_SETTINGS)
     plugin_config = config.get("plugins", {}).get("orphanScenesToGalleries", {})
     settings.update(plugin_config)
 
+    # Task arguments limiting the run to part of the library. Tasks with
+    # different arguments can run at the same time
+    args = json_input.get("args", {})
+    for key in ("pathPrefix", "shard"):
+        if args.get(key):
+            settings[key] = args[key]
+
+    # Capture this run's Stash traffic for offline replay (benchmark.py --replay)
+    recording = None
+    if settings.get("recordTrafficPath"):
+        recording = RecordingStash(stash, os.path.join(PLUGIN_DIR, settings["recordTrafficPath"]))
+        log.info(f"Recording Stash traffic to {recording.path}")
+        stash = recording
+
     # Create processor
     processor = OrphanSceneProcessor(stash, settings)
 
-    # Handle different modes
-    args = json_input.get("args", {})
-    mode = args.get("mode")
+    try:
+        # Handle hooks
+        hook_context = args.get("hookContext")
+        if hook_context:
+            processor.process_hook(hook_context)
+            return
 
-    if mode == "processAll":
-        processor.process_all()
-    else:
-        log.error(f"Unknown mode: {mode}")
+        # Handle different modes
+        mode = args.get("mode")
+
+        if mode == "processAll":
+            processor.process_all()
+        elif mode == "processIncremental":
+            processor.process_incremental()
+        elif mode == "resume":
+            processor.process_resume()
+        elif mode == "plan":
+            processor.process_plan()
+        elif mode == "applyPlan":
+            processor.process_apply_plan()
+        else:
+            log.error(f"Unknown mode: {mode}")
+    finally:
+        if recording is not None:
+            recording.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+Compact records for orphan scenes to galleries plugin.
+GraphQL results are converted once into slotted records, with folder paths
+interned to integer ids, so long-lived state holds no raw response dicts and
+each folder's parent is computed once.
+"""
+
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+def split_file_path(path: str) -> Tuple[str, str]:
+    """
+    Split a file path into its folder and file name.
+
+    Examples:
+        >>> split_file_path("/media/shoot/video.mp4")
+        ('/media/shoot', 'video.mp4')
+    """
+    path = Path(path)
+    return str(path.parent), path.name
+
+
+class FolderTable:
+    """
+    Interns folder paths to integer ids.
+
+    Every record refers to its folder by id, so a folder path is stored once
+    however many scenes and images it holds, and its parent is computed once.
+
+    Examples:
+        >>> folders = FolderTable()
+        >>> folders.intern("/media/shoot")
+        0
+        >>> folders.path(folders.parent(0))
+        '/media'
+    """
+
+    __slots__ = ('_ids', '_paths', '_parents', '_lock')
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._paths: List[str] = []
+        self._parents: List[Optional[int]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def intern(self, path: str) -> int:
+        """Id of a folder path, adding it if new."""
+        folder_id = self._ids.get(path)
+        if folder_id is not None:
+            return folder_id
+
+        with self._lock:
+            folder_id = self._ids.get(path)
+            if folder_id is None:
+                folder_id = len(self._paths)
+                self._paths.append(path)
+                self._parents.append(None)
+                self._ids[path] = folder_id
+            return folder_id
+
+    def path(self, folder_id: int) -> str:
+        return self._paths[folder_id]
+
+    def parent(self, folder_id: int) -> int:
+        """Id of a folder's parent. The root is its own parent."""
+        parent_id = self._parents[folder_id]
+        if parent_id is None:
+            parent_id = self.intern(str(Path(self._paths[folder_id]).parent))
+            self._parents[folder_id] = parent_id
+        return parent_id
+
+    def parent_path(self, path: str) -> str:
+        """Parent of a folder path, interning both."""
+        return self._paths[self.parent(self.intern(path))]
+
+
+class SceneRecord:
+    """A scene as needed for matching: id, title and its first file's folder."""
+
+    __slots__ = ('id', 'title', 'folder_id', 'file_name')
+
+    def __init__(self, id: str, title: str, folder_id: Optional[int], file_name: Optional[str]):
+        self.id = id
+        self.title = title
+        self.folder_id = folder_id  # None if the scene has no files
+        self.file_name = file_name
+
+
+class GalleryRecord:
+    """A gallery as needed for matching and logging."""
+
+    __slots__ = ('id', 'title', 'folder')
+
+    def __init__(self, id: str, title: str, folder: Optional[str]):
+        self.id = id
+        self.title = title
+        self.folder = folder  # None for zip and manually created galleries
+
+    def to_graphql(self) -> Dict:
+        """The gallery in the shape Stash returns it, for JSON output."""
+        return {'id': self.id, 'title': self.title, 'folder': {'path': self.folder} if self.folder else None}
+
+
+class ImageRecord:
+    """An image as needed for matching: id, folder and first gallery."""
+
+    __slots__ = ('id', 'folder_id', 'gallery')
+
+    def __init__(self, id: str, folder_id: int, gallery: Optional[GalleryRecord]):
+        self.id = id
+        self.folder_id = folder_id
+        self.gallery = gallery
+
+
+class RecordStore:
+    """
+    Converts GraphQL scenes, images and galleries to records, sharing one
+    folder table and one record per gallery id.
+    """
+
+    def __init__(self):
+        self.folders = FolderTable()
+        self._galleries: Dict[str, GalleryRecord] = {}
+
+    def folder_path(self, folder_id: Optional[int]) -> Optional[str]:
+        return self.folders.path(folder_id) if folder_id is not None else None
+
+    def scene(self, scene: Dict) -> SceneRecord:
+        folder_id = file_name = None
+        files = scene.get('files') or []
+        if files and files[0].get('path'):
+            folder, file_name = split_file_path(files[0]['path'])
+            folder_id = self.folders.intern(folder)
+        return SceneRecord(scene['id'], (scene.get('title') or '').strip(), folder_id, file_name)
+
+    def gallery(self, gallery: Optional[Dict]) -> Optional[GalleryRecord]:
+        if not gallery:
+            return None
+
+        record = self._galleries.get(gallery['id'])
+        if record is None:
+            folder = (gallery.get('folder') or {}).get('path') or None
+            # Concurrent workers may both create it; either record is equivalent
+            record = self._galleries.setdefault(
+                gallery['id'], GalleryRecord(gallery['id'], (gallery.get('title') or '').strip(), folder)
+            )
+        return record
+
+    def shared_gallery(self, gallery: GalleryRecord) -> GalleryRecord:
+        """The store's record for a gallery's id, e.g. for a copy made in a worker process."""
+        return self._galleries.setdefault(gallery.id, gallery)
+
+    def image(self, image: Dict) -> Optional[Tuple[str, ImageRecord]]:
+        """
+        Convert an image to (file path, record), or None if it has no file.
+        Only the first gallery is kept; matching never uses the others.
+        """
+        visual_files = image.get('visual_files') or []
+        path = visual_files[0].get('path') if visual_files else None
+        if not path:
+            return None
+
+        folder, _ = split_file_path(path)
+        galleries = image.get('galleries') or []
+        return path, ImageRecord(image['id'], self.folders.intern(folder), self.gallery(galleries[0] if galleries else None))
@@ -0,0 +1,157 @@
+"""
+Run metrics for orphan scenes to galleries plugin.
+Times each processing phase and every Stash call, so slow runs can be
+traced to scene paging, image lookups or mutations.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of a list of values.
+
+    Examples:
+        >>> percentile([1, 2, 3, 4], 0.5)
+        2
+        >>> percentile([1, 2, 3, 4], 0.95)
+        4
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(-(-fraction * len(ordered) // 1)), 1)
+    return ordered[rank - 1]
+
+
+def result_size(result) -> int:
+    """Number of records in a Stash call result."""
+    if isinstance(result, tuple):
+        # (count, results) from get_count=True
+        result = result[-1]
+    if isinstance(result, list):
+        return len(result)
+    return 0 if result is None else 1
+
+
+class RunMetrics:
+    """
+    Per-phase timings and per-method Stash call statistics for one run.
+
+    Phases are entered by the thread driving the run; calls made by worker
+    threads meanwhile are attributed to the phase in progress.
+
+    Examples:
+        >>> metrics = RunMetrics()
+        >>> with metrics.phase('fetch'):
+        ...     metrics.record_call('find_scenes', 0.25, 100)
+        >>> metrics.calls['find_scenes']['fetch']
+        [0.25]
+    """
+
+    def __init__(self):
+        self.phase_times: Dict[str, float] = defaultdict(float)
+        # method -> phase -> latencies
+        self.calls: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+        self.records: Dict[str, int] = defaultdict(int)
+        self.current_phase = 'other'
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a block of work as part of a phase. Phases can nest."""
+        previous = self.current_phase
+        self.current_phase = name
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.current_phase = previous
+            with self._lock:
+                self.phase_times[name] += elapsed
+                if previous != 'other':
+                    # Time spent in a nested phase is not counted twice
+                    self.phase_times[previous] -= elapsed
+
+    def record_call(self, method: str, seconds: float, records: int):
+        with self._lock:
+            self.calls[method][self.current_phase].append(seconds)
+            self.records[method] += records
+
+    def report(self) -> Dict:
+        """JSON-serializable summary of the run."""
+        with self._lock:
+            methods = {}
+            for method, phases in sorted(self.calls.items()):
+                latencies = [seconds for phase in phases.values() for seconds in phase]
+                methods[method] = {
+                    'calls': len(latencies),
+                    'total_seconds': round(sum(latencies), 3),
+                    'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+                    'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+                    'max_ms': round(max(latencies) * 1000, 1),
+                    'records': self.records[method],
+                    'calls_by_phase': {phase: len(values) for phase, values in sorted(phases.items())}
+                }
+
+            return {
+                'elapsed_seconds': round(time.perf_counter() - self.started, 3),
+                'phases': {phase: round(seconds, 3) for phase, seconds in self.phase_times.items()},
+                'stash_calls': methods
+            }
+
+    def summary_lines(self) -> List[str]:
+        """Human readable summary for the run log."""
+        report = self.report()
+        lines = [f"Elapsed: {report['elapsed_seconds']:.1f}s"]
+        for phase, seconds in report['phases'].items():
+            calls = sum(method['calls_by_phase'].get(phase, 0) for method in report['stash_calls'].values())
+            lines.append(f"  {phase}: {seconds:.1f}s, {calls} Stash calls")
+        for method, stats in report['stash_calls'].items():
+            lines.append(
+                f"  {method}: {stats['calls']} calls, {stats['total_seconds']:.1f}s total, "
+                f"p50 {stats['p50_ms']:.0f}ms, p95 {stats['p95_ms']:.0f}ms, max {stats['max_ms']:.0f}ms, "
+                f"{stats['records']} records"
+            )
+        return lines
+
+    def write_report(self, path: str, extra: Optional[Dict] = None):
+        """Append the report as one JSON line, so reports accumulate into a trend."""
+        report = dict(extra or {})
+        report.update(self.report())
+        with open(path, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+class InstrumentedStash:
+    """
+    Wraps a StashInterface so every method call is timed and recorded in a
+    RunMetrics. Attributes other than methods are passed through.
+    """
+
+    def __init__(self, stash, metrics: RunMetrics):
+        self._stash = stash
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._stash, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            result = None
+            try:
+                result = attr(*args, **kwargs)
+                return result
+            finally:
+                self._metrics.record_call(name, time.perf_counter() - started, result_size(result))
+
+        return timed
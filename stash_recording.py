@@ -0,0 +1,138 @@
+"""
+GraphQL traffic recording and replay for orphan scenes to galleries plugin.
+Captures the Stash calls made during a run to a gzip-compressed JSON lines
+file, so the same run can be replayed and profiled offline with no server.
+"""
+
+import copy
+import gzip
+import json
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, Tuple
+
+# Calls that change data. Replaying a run with different settings sends
+# different mutations, which are acknowledged instead of failing the replay.
+MUTATIONS = {'update_scenes'}
+
+
+def request_key(method: str, args: Tuple, kwargs: Dict) -> str:
+    """
+    Canonical form of a call, used to look up its recorded response.
+
+    Examples:
+        >>> request_key('find_gallery', ('1',), {'fragment': 'id'})
+        'find_gallery ["1"] {"fragment": "id"}'
+    """
+    return f"{method} {json.dumps(list(args), sort_keys=True)} {json.dumps(kwargs, sort_keys=True)}"
+
+
+class RecordingStash:
+    """
+    Wraps a StashInterface and appends every call with its arguments,
+    response and duration to a gzip JSON lines file.
+
+    Recordings of several runs (for example one per match strategy) can be
+    appended to the same file and replayed together.
+    """
+
+    def __init__(self, stash, path: str):
+        self._stash = stash
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self.path = path
+
+    def __getattr__(self, name):
+        attr = getattr(self._stash, name)
+        if not callable(attr):
+            return attr
+
+        def recorded(*args, **kwargs):
+            # stashapi adds keys to filter dicts, so capture the request first
+            key = request_key(name, copy.deepcopy(args), copy.deepcopy(kwargs))
+            started = time.perf_counter()
+            result = attr(*args, **kwargs)
+            line = json.dumps({
+                'key': key,
+                'seconds': round(time.perf_counter() - started, 6),
+                'result': result
+            })
+            with self._lock:
+                self._file.write(line + '\n')
+            return result
+
+        return recorded
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ReplayMissError(Exception):
+    """A call was made that the recording has no response for."""
+
+
+class ReplayStash:
+    """
+    Serves recorded responses in place of a StashInterface.
+
+    Identical requests are answered in recording order, repeating the last
+    response once they run out. Exposes the same counters as FakeStash
+    (calls, bytes_returned, time_in_stash) so the benchmark can report on
+    replays, plus recorded_seconds, the server time of the replayed calls
+    when they were recorded.
+
+    Args:
+        path: Recording made by RecordingStash
+        replay_latency: Sleep for each call's recorded duration, to
+            reproduce the server's share of the run time
+    """
+
+    def __init__(self, path: str, replay_latency: bool = False):
+        self.replay_latency = replay_latency
+        self.responses: Dict[str, Deque[Tuple[float, str]]] = defaultdict(deque)
+        self.calls = Counter()
+        self.misses = Counter()
+        self.bytes_returned = 0
+        self.time_in_stash = 0.0
+        self.recorded_seconds = 0.0
+        self._lock = threading.Lock()
+
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                # Keep responses encoded until used, like a server would
+                self.responses[record['key']].append((record['seconds'], json.dumps(record['result'])))
+
+    def __len__(self) -> int:
+        return sum(len(responses) for responses in self.responses.values())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def replayed(*args, **kwargs):
+            started = time.perf_counter()
+            key = request_key(name, args, kwargs)
+            with self._lock:
+                responses = self.responses.get(key)
+                if not responses:
+                    if name in MUTATIONS:
+                        self.calls[name] += 1
+                        return None
+                    self.misses[name] += 1
+                    raise ReplayMissError(f"No recorded response for {key[:300]}")
+                seconds, payload = responses.popleft() if len(responses) > 1 else responses[0]
+                self.calls[name] += 1
+                self.bytes_returned += len(payload)
+                self.recorded_seconds += seconds
+
+            if self.replay_latency:
+                time.sleep(seconds)
+            result = json.loads(payload)
+            with self._lock:
+                self.time_in_stash += time.perf_counter() - started
+            return result
+
+        return replayed
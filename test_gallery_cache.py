@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Test suite for the persistent folder -> gallery cache
+Uses an in-memory SQLite database, no Stash dependencies
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+from gallery_cache import FolderGalleryCache
+
+
+def test_positive_and_negative_entries():
+    """Matches and "no gallery here" results are both cached"""
+    print("\n" + "=" * 70)
+    print("TEST 1: Positive and Negative Entries")
+    print("=" * 70)
+
+    cache = FolderGalleryCache(":memory:")
+    cache.put("/media/shoot", {"id": "1"}, gallery_id="1")
+    cache.put("/media/empty", None)
+
+    print(f"  /media/shoot: {cache.get('/media/shoot')}")
+    print(f"  /media/empty: {cache.get('/media/empty')}")
+    print(f"  /media/other: {cache.get('/media/other')}")
+    assert cache.get("/media/shoot") == (True, {"id": "1"}), "Should return cached match"
+    assert cache.get("/media/empty") == (True, None), "Should return cached negative result"
+    assert cache.get("/media/other") == (False, None), "Should miss unknown folder"
+
+    print("✓ PASSED: Positive and negative entries are cached")
+
+
+def test_max_age():
+    """Entries older than max age are ignored"""
+    print("\n" + "=" * 70)
+    print("TEST 2: Max Age")
+    print("=" * 70)
+
+    cache = FolderGalleryCache(":memory:", max_age_hours=1)
+    cache.put("/media/shoot", None)
+    assert cache.get("/media/shoot")[0], "Fresh entry should hit"
+
+    cache.max_age_seconds = 0
+    time.sleep(0.01)
+    print(f"  Expired entry: {cache.get('/media/shoot')}")
+    assert not cache.get("/media/shoot")[0], "Expired entry should miss"
+
+    print("✓ PASSED: Expired entries are ignored")
+
+
+def test_invalidate_gallery():
+    """A changed gallery invalidates every folder that could match it"""
+    print("\n" + "=" * 70)
+    print("TEST 3: Gallery Invalidation")
+    print("=" * 70)
+
+    cache = FolderGalleryCache(":memory:")
+    folders = {
+        "/media/session1": True,            # Same folder as the gallery
+        "/media": True,                      # Ancestor - gallery is a descendant
+        "/media/session1/video": True,       # Child - gallery is its direct parent
+        "/media/session1/video/deep": False,  # Grandchild - gallery is a grandparent
+        "/media/session2": False,            # Sibling
+        "/media/session10": False,           # Similar prefix
+    }
+    for folder in folders:
+        cache.put(folder, None)
+    cache.put("/elsewhere", {"id": "7"}, gallery_id="7")
+
+    removed = cache.invalidate_gallery("3", "/media/session1")
+    print(f"  Removed {removed} entries for gallery folder /media/session1")
+    for folder, should_invalidate in folders.items():
+        hit, _ = cache.get(folder)
+        print(f"  {folder}: cached={hit}")
+        assert hit != should_invalidate, f"Wrong invalidation for {folder}"
+
+    cache.invalidate_gallery("7")
+    assert not cache.get("/elsewhere")[0], "Entries matched to the gallery should be removed"
+
+    print("✓ PASSED: Gallery changes invalidate related folders only")
+
+
+def run_all_tests():
+    """Run all tests"""
+    print("\n" + "=" * 70)
+    print("RUNNING ALL FOLDER CACHE TESTS")
+    print("=" * 70)
+
+    try:
+        test_positive_and_negative_entries()
+        test_max_age()
+        test_invalidate_gallery()
+
+        print("\n" + "=" * 70)
+        print("✓✓✓ ALL TESTS PASSED ✓✓✓")
+        print("=" * 70)
+        return True
+
+    except AssertionError as e:
+        print("\n✗✗✗ TEST FAILED ✗✗✗")
+        print(f"Error: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)
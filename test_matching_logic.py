@@ -6,12 +6,16 @@ Uses the extracted should_match_folder() function for unit testing
 """
 
 import os
+import random
+import re
 import sys
 from pathlib import Path
 
 # Import the matching function from the standalone module
 sys.path.insert(0, os.path.dirname(__file__))
-from gallery_matcher import should_match_folder
+from fake_stash import natural_key
+from gallery_matcher import (FolderGalleryIndex, FolderTrie, find_first_descendant, match_folders_batch,
+                             should_match_folder, sorts_before_regex, subfolder_image_regex)
 
 
 def test_example_1_same_folder():
@@ -197,6 +201,219 @@ def test_edge_cases():
     print("\n✓ PASSED: All edge cases handled correctly")
 
 
+def random_folder_tree(rng, depth=4, fanout=3):
+    """Generate a random folder tree, including similar-prefix siblings."""
+    folders = ["/media"]
+    frontier = ["/media"]
+    for _ in range(depth):
+        next_frontier = []
+        for folder in frontier:
+            for _ in range(rng.randint(0, fanout)):
+                name = rng.choice(["a", "b", "a-b", "a1", "ab", "pics", "video"])
+                child = folder + os.sep + name
+                if child not in folders:
+                    folders.append(child)
+                    next_frontier.append(child)
+        frontier = next_frontier
+    return folders
+
+
+def hierarchical_search(folder_entries, scene_folder):
+    """
+    Reference implementation of the per-scene search in
+    match_by_folder_hierarchy, using should_match_folder on every folder.
+    """
+    if folder_entries.get(scene_folder) is not None:
+        return scene_folder, folder_entries[scene_folder]
+
+    parent_path = str(Path(scene_folder).parent)
+    if not parent_path or parent_path == scene_folder:
+        return None
+
+    for folder in sorted(folder_entries):
+        if not should_match_folder(folder, scene_folder, parent_path):
+            continue
+        if folder_entries[folder] is not None:
+            return folder, folder_entries[folder]
+    return None
+
+
+def test_folder_gallery_index():
+    """FolderGalleryIndex gives the same result as the hierarchical search"""
+    print("\n" + "=" * 70)
+    print("TEST 6: Prefetch Index Equivalence")
+    print("=" * 70)
+
+    rng = random.Random(1234)
+    for trial in range(200):
+        folders = random_folder_tree(rng)
+
+        # First image of each image folder: either a gallery or no gallery
+        folder_entries = {}
+        for folder in rng.sample(folders, rng.randint(0, len(folders))):
+            folder_entries[folder] = rng.choice([None, f"gallery:{folder}"])
+
+        index = FolderGalleryIndex()
+        for folder, entry in folder_entries.items():
+            assert index.add(folder, entry), "First image of a folder should be recorded"
+            assert not index.add(folder, "later-image"), "Later images should be ignored"
+
+        for scene_folder in folders:
+            expected = hierarchical_search(folder_entries, scene_folder)
+            actual = index.find_match(scene_folder)
+            assert actual == expected, (
+                f"Trial {trial}: index returned {actual} for {scene_folder}, expected {expected}"
+            )
+
+    print("  ✓ 200 random trees matched the hierarchical search")
+    print("\n✓ PASSED: Prefetch index is equivalent to per-scene search")
+
+
+def test_folder_trie():
+    """FolderTrie.find_related agrees with should_match_folder"""
+    print("\n" + "=" * 70)
+    print("TEST 7: Folder Trie Equivalence")
+    print("=" * 70)
+
+    # Hand-written examples from the README
+    trie = FolderTrie()
+    for folder in ["/media/shoots/session1", "/media/studio/2024/march/gallery",
+                   "/media/studio/2024/march", "/media/studio/2024"]:
+        trie.add(folder)
+
+    related = trie.find_related("/media/shoots/session1/video")
+    print(f"  Direct parent: {related}")
+    assert related.parent == "/media/shoots/session1", "Should find direct parent"
+
+    related = trie.find_related("/media/studio/2024/april")
+    print(f"  Sibling: {related}")
+    assert related.all() == ["/media/studio/2024"], "Should only find direct parent, not sibling"
+
+    related = trie.find_related("/media/studio/2024/march/videos")
+    print(f"  Grandparent: {related}")
+    assert related.all() == ["/media/studio/2024/march"], "Should NOT find grandparent"
+
+    # Randomized trees
+    rng = random.Random(4321)
+    for trial in range(200):
+        folders = random_folder_tree(rng, depth=5)
+        gallery_folders = rng.sample(folders, rng.randint(0, len(folders)))
+
+        trie = FolderTrie()
+        for folder in gallery_folders:
+            assert trie.add(folder), "New folder should be added"
+            assert not trie.add(folder), "Duplicate folder should be ignored"
+        assert len(trie) == len(gallery_folders)
+
+        for scene_folder in folders:
+            parent_path = str(Path(scene_folder).parent)
+            expected = sorted(
+                folder for folder in gallery_folders
+                if should_match_folder(folder, scene_folder, parent_path)
+            )
+            actual = sorted(trie.find_related(scene_folder).all())
+            assert actual == expected, (
+                f"Trial {trial}: trie returned {actual} for {scene_folder}, expected {expected}"
+            )
+
+    print("  ✓ 200 random trees matched should_match_folder")
+    print("\n✓ PASSED: Folder trie is equivalent to should_match_folder")
+
+
+def test_first_descendant_collation():
+    """Paged child folder search agrees with sorted folder order in any collation"""
+    print("\n" + "=" * 70)
+    print("TEST 8: Child Folder Search Under Stash Collation")
+    print("=" * 70)
+
+    rng = random.Random(2468)
+    for trial in range(200):
+        # Mixed-case and numbered names, which Stash's collation orders
+        # differently from Python's
+        variants = {}
+        folders = []
+        for folder in random_folder_tree(rng, depth=4):
+            parts = folder.split(os.sep)
+            for i in range(2, len(parts)):
+                key = os.sep.join(parts[:i + 1])
+                variants.setdefault(key, rng.choice([parts[i], parts[i].upper(), parts[i] + "2", parts[i] + "10"]))
+                parts[i] = variants[key]
+            folders.append(os.sep.join(parts))
+
+        # Images directly in each folder, some without a gallery. Names are
+        # chosen so a folder's images interleave with its subfolders' images.
+        images = {}
+        for folder in rng.sample(folders, rng.randint(0, len(folders))):
+            for name in rng.sample(["0.jpg", "b.jpg", "Q.jpg", "z.jpg"], rng.randint(1, 3)):
+                images[folder + os.sep + name] = rng.choice([None, f"gallery:{folder}"])
+
+        for collation in (None, natural_key):
+            def first_entry(folder):
+                in_folder = sorted((path for path in images if str(Path(path).parent) == folder), key=collation)
+                return images[in_folder[0]] if in_folder else None
+
+            for scene_folder in folders:
+                prefix = scene_folder + os.sep
+                expected = None
+                for folder in sorted(folders):
+                    if folder.startswith(prefix) and first_entry(folder) is not None:
+                        expected = folder, first_entry(folder)
+                        break
+
+                # Filtered by the same regex Stash is sent
+                def list_images(before, skip):
+                    pattern = re.compile(subfolder_image_regex(scene_folder, before))
+                    below = sorted((path for path in images if pattern.match(path)), key=collation)
+                    return [(path, images[path]) for path in below[skip:]]
+
+                actual = find_first_descendant(scene_folder, list_images)
+                assert actual == expected, (
+                    f"Trial {trial}: search returned {actual} for {scene_folder}, expected {expected}"
+                )
+
+    print("  ✓ 200 random trees matched sorted folder order, in byte and natural path order")
+
+    pattern = re.compile(sorts_before_regex("shoot-2/Pics"))
+    names = ["shoot", "shoot-", "shoot-10", "shoot-2", "shoot-2/", "shoot-2/Pic", "shoot-2/PICS", "shoot-2/Pics",
+             "shoot-2/Pics/a", "shoot-2/pics", "shoot.2", "Shoot-3", "shoot-3", "s\\x", "", "shoot-2/Pics2"]
+    for name in names:
+        assert bool(pattern.fullmatch(name)) == (0 < len(name) and name < "shoot-2/Pics"), \
+            f"sorts_before_regex disagrees with Python's order for {name!r}"
+    print(f"  ✓ Regex for folders sorting before a folder agrees with Python's order on {len(names)} names")
+    print("\n✓ PASSED: Child folder search does not depend on Stash's collation")
+
+
+def test_match_folders_batch():
+    """Batch matching gives the same pairs as should_match_folder"""
+    print("\n" + "=" * 70)
+    print("TEST 9: Batch Folder Matching")
+    print("=" * 70)
+
+    rng = random.Random(1357)
+    pairs = 0
+    for trial in range(200):
+        folders = random_folder_tree(rng, depth=5)
+        scene_folders = rng.sample(folders, rng.randint(0, len(folders)))
+        image_folders = rng.sample(folders, rng.randint(0, len(folders)))
+
+        matches = match_folders_batch(scene_folders, image_folders)
+        assert set(matches) == set(scene_folders), "Every scene folder should have an entry"
+
+        for scene_folder in scene_folders:
+            parent_path = str(Path(scene_folder).parent)
+            expected = sorted(folder for folder in image_folders
+                              if should_match_folder(folder, scene_folder, parent_path))
+            related = matches[scene_folder]
+            assert sorted(related.all()) == expected, (
+                f"Trial {trial}: batch returned {related.all()} for {scene_folder}, expected {expected}"
+            )
+            assert related.descendants == sorted(related.descendants), "Descendants should be sorted"
+            pairs += len(image_folders)
+
+    print("  ✓ 200 random trees matched should_match_folder over {pairs} pairs")
+    print("\n✓ PASSED: Batch matching is equivalent to per-pair matching")
+
+
 def run_all_tests():
     """Run all tests"""
     print("\n" + "=" * 70)
@@ -209,6 +426,10 @@ def run_all_tests():
         test_example_3_child_folder()
         test_example_4_sibling_prevention()
         test_edge_cases()
+        test_folder_gallery_index()
+        test_folder_trie()
+        test_first_descendant_collation()
+        test_match_folders_batch()
 
         print("\n" + "=" * 70)
         print("✓✓✓ ALL TESTS PASSED ✓✓✓")
@@ -219,10 +440,14 @@ def run_all_tests():
         print("  ✓ Matches images in child/subfolders")
         print("  ✓ Prevents matching across sibling folders")
         print("  ✓ Handles edge cases properly")
+        print("  ✓ Prefetch index agrees with the hierarchical search")
+        print("  ✓ Folder trie agrees with should_match_folder")
+        print("  ✓ Child folder search does not depend on Stash's path collation")
+        print("  ✓ Batch matching agrees with should_match_folder")
         return True
 
     except AssertionError as e:
-        print(f"\n✗✗✗ TEST FAILED ✗✗✗")
+        print("\n✗✗✗ TEST FAILED ✗✗✗")
         print(f"Error: {e}")
         return False
 
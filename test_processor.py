@@ -0,0 +1,861 @@
+#!/usr/bin/env python3
+"""
+Test suite for OrphanSceneProcessor against the in-process fake Stash
+Runs whole processing passes over a small synthetic library
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(__file__))
+import stashapi.log as log
+from fake_stash import FakeStash, SyntheticLibrary, match_string
+from gallery_matcher import should_match_folder
+from orphan_scenes_to_galleries import DEFAULT_SETTINGS, OrphanSceneProcessor
+from records import RecordStore
+from stash_recording import RecordingStash, ReplayMissError, ReplayStash
+
+logging.getLogger('StashLogger').setLevel(logging.WARNING)
+log.DISABLE_PROGRESS = True
+
+
+def run_processor(stash, state_dir, **settings):
+    """Process the whole fake library and return the processor."""
+    config = dict(DEFAULT_SETTINGS)
+    config['statePath'] = os.path.join(state_dir, 'run_state.json')
+    config['cachePath'] = os.path.join(state_dir, 'folder_cache.sqlite')
+    config['checkpointPath'] = os.path.join(state_dir, 'checkpoint.json')
+    config.update(settings)
+    processor = OrphanSceneProcessor(stash, config)
+    processor.process_all()
+    return processor
+
+
+def scene_galleries(library):
+    return {scene['id']: sorted(g['id'] for g in scene['galleries']) for scene in library.scenes}
+
+
+def test_fake_path_filters():
+    """The fake's indexed path lookups agree with a full scan"""
+    print("\n" + "=" * 70)
+    print("TEST 1: Fake Stash Path Filters")
+    print("=" * 70)
+
+    library = SyntheticLibrary(scenes=50, images=2000, galleries=40, depth=3, fanout=3)
+    stash = FakeStash(library)
+    folder = library.galleries['1']['folder']['path']
+    parent = os.path.dirname(folder)
+    criteria = [
+        {"modifier": "INCLUDES", "value": folder},
+        {"modifier": "INCLUDES", "value": parent},
+        {"modifier": "MATCHES_REGEX", "value": f"^{parent}/[^/]+/[^/]+$"},
+        {"modifier": "MATCHES_REGEX", "value": f"^(?:{folder}(?:/.*)?|{parent})$"},
+    ]
+
+    all_paths = [image['visual_files'][0]['path'] for image in stash.find_images(filter={"per_page": -1})]
+    for criterion in criteria:
+        found = [image['visual_files'][0]['path'] for image in stash.find_images(f={"path": criterion})]
+        expected = [path for path in all_paths if match_string(path, criterion)]
+        print(f"  {criterion['modifier']} {criterion['value']}: {len(found)} images")
+        assert found == expected, f"Indexed lookup disagrees with a full scan for {criterion}"
+    assert all_paths == sorted(all_paths), "Images should be returned sorted by path"
+
+    print("✓ PASSED: Indexed lookups match a full scan")
+
+
+def test_strategies_agree():
+    """Every match strategy assigns the same galleries"""
+    print("\n" + "=" * 70)
+    print("TEST 2: Match Strategies Agree")
+    print("=" * 70)
+
+    results = {}
+    for strategy in ('query', 'prefetch', 'galleries', 'firstHit'):
+        library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=1)
+        with tempfile.TemporaryDirectory() as state_dir:
+            processor = run_processor(FakeStash(library), state_dir, matchStrategy=strategy)
+        results[strategy] = scene_galleries(library)
+        print(f"  {strategy}: assigned {processor.stats['assigned']}, skipped {processor.stats['skipped']}")
+        assert processor.stats['assigned'] > 0, "Synthetic library should have matchable orphans"
+        assert processor.stats['errors'] == 0, "No assignment should fail"
+
+    assert results['query'] == results['prefetch'] == results['galleries'] == results['firstHit'], \
+        "Strategies should agree on a library where every image of a folder is in the same gallery"
+
+    print("✓ PASSED: All strategies produce identical assignments")
+
+
+def test_concurrency_and_batching():
+    """Worker count and batch size do not change the outcome"""
+    print("\n" + "=" * 70)
+    print("TEST 3: Concurrency and Batching")
+    print("=" * 70)
+
+    results = []
+    for concurrency, batch_size in ((1, 100), (4, 1), (4, 7)):
+        library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=2)
+        stash = FakeStash(library)
+        with tempfile.TemporaryDirectory() as state_dir:
+            run_processor(stash, state_dir, concurrency=concurrency, assignBatchSize=batch_size)
+        results.append(scene_galleries(library))
+        print(f"  concurrency={concurrency} batch={batch_size}: {stash.calls['update_scenes']} update calls")
+
+    assert results[0] == results[1] == results[2], "Results should not depend on concurrency or batching"
+
+    print("✓ PASSED: Concurrency and batching are invisible in the results")
+
+
+def test_failed_assignment_is_isolated():
+    """A scene that cannot be updated does not block the rest of its batch"""
+    print("\n" + "=" * 70)
+    print("TEST 4: Failed Assignment Isolation")
+    print("=" * 70)
+
+    class FailingStash(FakeStash):
+        def update_scenes(self, updates_input):
+            if bad_id in updates_input['ids']:
+                raise Exception(f"Scene {bad_id} is locked")
+            return super().update_scenes(updates_input)
+
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=3)
+    expected = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=3)
+    with tempfile.TemporaryDirectory() as state_dir:
+        run_processor(FakeStash(expected), state_dir)
+        assigned = [scene['id'] for old, scene in zip(library.scenes, expected.scenes)
+                    if scene['galleries'] != old['galleries']]
+        bad_id = assigned[len(assigned) // 2]
+        processor = run_processor(FailingStash(library), state_dir)
+
+    print(f"  Failing scene: {bad_id}, errors: {processor.stats['errors']}")
+    assert processor.stats['errors'] == 1, "Only the failing scene should count as an error"
+    for scene, expected_scene in zip(library.scenes, expected.scenes):
+        if scene['id'] == bad_id:
+            assert not scene['galleries'], "Failing scene should stay orphaned"
+        else:
+            assert scene['galleries'] == expected_scene['galleries'], f"Scene {scene['id']} should be assigned"
+
+    print("✓ PASSED: Only the failing scene is left unassigned")
+
+
+def test_run_metrics():
+    """Every Stash call is recorded under the phase that made it"""
+    print("\n" + "=" * 70)
+    print("TEST 5: Run Metrics")
+    print("=" * 70)
+
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=4)
+    stash = FakeStash(library)
+    with tempfile.TemporaryDirectory() as state_dir:
+        report_path = os.path.join(state_dir, 'metrics.jsonl')
+        processor = run_processor(stash, state_dir, matchStrategy='prefetch', metricsReportPath=report_path)
+        processor.write_metrics_report()
+        with open(report_path) as f:
+            reports = [json.loads(line) for line in f]
+
+    report = processor.metrics.report()
+    for method, stats in report['stash_calls'].items():
+        print(f"  {method}: {stats['calls']} calls by phase {stats['calls_by_phase']}")
+        assert stats['calls'] == stash.calls[method], f"Every {method} call should be recorded"
+    assert set(report['stash_calls']['find_images']['calls_by_phase']) == {'index'}, \
+        "Prefetch should only query images while building the index"
+    assert set(report['stash_calls']['update_scenes']['calls_by_phase']) == {'assign'}, \
+        "Mutations belong to the assign phase"
+    assert len(reports) == 2, "Each report should be appended as a new line"
+    assert reports[0]['stats']['assigned'] == processor.stats['assigned'], "Report should include run stats"
+
+    print("✓ PASSED: Calls are counted and attributed to phases")
+
+
+def test_record_and_replay():
+    """A recorded run replays offline with the same results"""
+    print("\n" + "=" * 70)
+    print("TEST 6: Record and Replay")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        recording_path = os.path.join(state_dir, 'traffic.jsonl.gz')
+        recorded = {}
+        for strategy in ('query', 'prefetch'):
+            library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=5)
+            recording = RecordingStash(FakeStash(library), recording_path)
+            processor = run_processor(recording, state_dir, matchStrategy=strategy, dryRun=True)
+            recording.close()
+            recorded[strategy] = (processor.stats, processor.metrics.report()['stash_calls'])
+
+        for strategy, (stats, calls) in recorded.items():
+            replay = ReplayStash(recording_path)
+            processor = run_processor(replay, state_dir, matchStrategy=strategy, dryRun=True)
+            print(f"  {strategy}: replayed {sum(replay.calls.values())} calls, stats {processor.stats}")
+            assert processor.stats == stats, "Replay should reproduce the recorded run"
+            assert {method: replay.calls[method] for method in calls} == \
+                {method: method_stats['calls'] for method, method_stats in calls.items()}, \
+                "Replay should make the same calls"
+            assert not replay.misses, "Every call should be in the recording"
+
+        replay = ReplayStash(recording_path)
+        try:
+            replay.find_gallery('does-not-exist')
+            assert False, "Unrecorded calls should fail"
+        except ReplayMissError:
+            pass
+
+    print("✓ PASSED: Replay reproduces recorded runs without a server")
+
+
+def test_compact_records():
+    """GraphQL results are held as records sharing folders and galleries"""
+    print("\n" + "=" * 70)
+    print("TEST 7: Compact Records")
+    print("=" * 70)
+
+    store = RecordStore()
+    gallery = {'id': '7', 'title': ' Shoot ', 'folder': {'path': '/media/shoot'}}
+    scene = store.scene({'id': '1', 'title': '', 'files': [{'path': '/media/shoot/video/a.mp4'}]})
+    image = store.image({'id': '2', 'visual_files': [{'path': '/media/shoot/b.jpg'}], 'galleries': [gallery]})
+    other = store.image({'id': '3', 'visual_files': [{'path': '/media/shoot/c.jpg'}], 'galleries': [dict(gallery)]})
+
+    assert store.folder_path(scene.folder_id) == '/media/shoot/video' and scene.file_name == 'a.mp4'
+    assert image[0] == '/media/shoot/b.jpg', "Image path should be returned alongside its record"
+    assert image[1].folder_id == store.folders.parent(scene.folder_id), "Folders should be interned once"
+    assert image[1].gallery is other[1].gallery, "Galleries should be shared by id"
+    assert image[1].gallery.title == 'Shoot'
+    assert store.image({'id': '4', 'visual_files': []}) is None, "Images without files are skipped"
+    assert store.folders.parent_path('/') == '/', "The root should be its own parent"
+    assert store.gallery(image[1].gallery.to_graphql()) is image[1].gallery
+
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=6)
+    with tempfile.TemporaryDirectory() as state_dir:
+        processor = run_processor(FakeStash(library), state_dir, matchStrategy='prefetch')
+    print(f"  {len(processor.records.folders)} interned folders for {processor.stats['folders']} scene folders")
+    assert not processor.pending_assignments, "Every assignment should be flushed"
+
+    print("✓ PASSED: Records share folders and galleries")
+
+
+def test_resume_from_checkpoint():
+    """An interrupted run resumes after its last checkpoint with the same results"""
+    print("\n" + "=" * 70)
+    print("TEST 8: Resume From Checkpoint")
+    print("=" * 70)
+
+    class InterruptedStash(FakeStash):
+        def find_scenes(self, *args, **kwargs):
+            if self.calls['find_scenes'] == 4:
+                raise Exception("Stash restarted")
+            return super().find_scenes(*args, **kwargs)
+
+    settings = dict(pageSize=50, checkpointPages=1, assignBatchSize=1000)
+    expected = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=7)
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=7)
+    with tempfile.TemporaryDirectory() as state_dir:
+        full = run_processor(FakeStash(expected), state_dir, **settings)
+
+        try:
+            run_processor(InterruptedStash(library), state_dir, **settings)
+            assert False, "Run should have been interrupted"
+        except Exception as e:
+            assert 'restarted' in str(e)
+        checkpoint_path = os.path.join(state_dir, 'checkpoint.json')
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        print(f"  Checkpoint after scene {checkpoint['last_scene_id']}: {checkpoint['processed']} processed, "
+              f"{sum(len(scenes) for _, scenes in checkpoint['pending_assignments'])} queued assignments")
+        assert checkpoint['pending_assignments'], "Queued assignments should be saved, not flushed"
+
+        stash = FakeStash(library)
+        config = dict(DEFAULT_SETTINGS, statePath=os.path.join(state_dir, 'run_state.json'),
+                      checkpointPath=checkpoint_path, **settings)
+        resumed = OrphanSceneProcessor(stash, config)
+        resumed.process_resume()
+
+        print(f"  Full run: {full.stats}")
+        print(f"  Resumed:  {resumed.stats}, {stash.calls['find_scenes']} find_scenes calls")
+        assert scene_galleries(library) == scene_galleries(expected), "Resumed run should assign the same galleries"
+        assert resumed.stats['skipped'] == full.stats['skipped'], "Scenes before the checkpoint should not be redone"
+        assert not os.path.exists(checkpoint_path), "A finished run should remove its checkpoint"
+
+    print("✓ PASSED: Interrupted runs resume where they stopped")
+
+
+def test_time_budget():
+    """A run that runs out of time stops cleanly and can be resumed"""
+    print("\n" + "=" * 70)
+    print("TEST 9: Time Budget")
+    print("=" * 70)
+
+    settings = dict(pageSize=50, checkpointPages=0, concurrency=2)
+    expected = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=8)
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=8)
+    with tempfile.TemporaryDirectory() as state_dir:
+        full = run_processor(FakeStash(expected), state_dir, **settings)
+        os.remove(os.path.join(state_dir, 'run_state.json'))
+
+        stash = FakeStash(library, latency=0.002)
+        stopped = run_processor(stash, state_dir, maxRuntimeMinutes=0.001, **settings)
+        print(f"  Stopped: {stopped.stats}")
+        assert stopped.out_of_time, "Run should stop when the time budget is used up"
+        assert stopped.stats['remaining'] > 0, "Unprocessed orphans should be reported"
+        assert not stopped.pending_assignments, "Queued assignments should be flushed when stopping"
+        assert not os.path.exists(os.path.join(state_dir, 'run_state.json')), \
+            "An unfinished run should not move the incremental high-water mark"
+
+        stash.latency = 0
+        config = dict(DEFAULT_SETTINGS, statePath=os.path.join(state_dir, 'run_state.json'),
+                      checkpointPath=os.path.join(state_dir, 'checkpoint.json'), **settings)
+        resumed = OrphanSceneProcessor(stash, config)
+        resumed.process_resume()
+        print(f"  Resumed: {resumed.stats}")
+
+    assert not resumed.out_of_time
+    assert scene_galleries(library) == scene_galleries(expected), "Resumed run should finish the job"
+    assert resumed.stats['skipped'] == full.stats['skipped'], "No scene should be processed twice"
+
+    print("✓ PASSED: Time-limited runs stop, report and resume")
+
+
+def test_shards():
+    """Hash shards and path prefixes split the work without overlap"""
+    print("\n" + "=" * 70)
+    print("TEST 10: Sharded Runs")
+    print("=" * 70)
+
+    expected = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=9)
+    with tempfile.TemporaryDirectory() as state_dir:
+        full = run_processor(FakeStash(expected), state_dir)
+
+    for strategy in ('query', 'prefetch'):
+        library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=9)
+        processed = assigned = 0
+        with tempfile.TemporaryDirectory() as state_dir:
+            for k in range(1, 5):
+                processor = run_processor(FakeStash(library), state_dir, matchStrategy=strategy, shard=f"{k}/4")
+                processed += processor.stats['assigned'] + processor.stats['skipped']
+                assert processor.stats['total_orphans'] == processor.stats['assigned'] + processor.stats['skipped'], \
+                    "A finished shard should report the orphans it processed, not the estimate"
+                assigned += processor.stats['assigned']
+            state_files = sorted(name for name in os.listdir(state_dir) if name.startswith('run_state'))
+        print(f"  {strategy}: {assigned} assigned over 4 shards, state files {state_files}")
+        assert scene_galleries(library) == scene_galleries(expected), "Shards together should do the full run"
+        assert processed == full.stats['assigned'] + full.stats['skipped'], "No scene should be in two shards"
+        assert len(state_files) == 4, "Each shard should keep its own run state"
+
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=9)
+    prefix = '/library/d0'
+    with tempfile.TemporaryDirectory() as state_dir:
+        stash = FakeStash(library)
+        processor = run_processor(stash, state_dir, pathPrefix=prefix + '/', matchStrategy='prefetch')
+    original = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=9)
+    changed = [scene['id'] for old, scene in zip(original.scenes, library.scenes) if scene['galleries'] != old['galleries']]
+    print(f"  {prefix}: {processor.stats['assigned']} assigned, {stash.calls['find_images']} image pages")
+    for scene, expected_scene in zip(library.scenes, expected.scenes):
+        in_prefix = scene['files'][0]['path'].startswith(prefix + '/')
+        if in_prefix:
+            assert scene['galleries'] == expected_scene['galleries'], "Scenes in the prefix should be assigned"
+        elif scene['galleries'] != expected_scene['galleries']:
+            assert not scene['galleries'], f"Scene {scene['id']} outside the prefix should not be touched"
+    assert processor.stats['assigned'] == len(changed) > 0, "Only scenes in the prefix should be assigned"
+
+    print("✓ PASSED: Shards cover the library exactly once")
+
+
+def test_match_processes():
+    """Matching on worker processes gives the same results in the same order"""
+    print("\n" + "=" * 70)
+    print("TEST 11: Match Processes")
+    print("=" * 70)
+
+    class StartMethodLog(FakeStash):
+        """Records how the process pool was started, once it exists."""
+        processor = None
+
+        def find_scenes(self, *args, **kwargs):
+            if self.processor is not None and self.processor.match_pool is not None:
+                start_methods.add(self.processor.match_pool.start_method)
+            return super().find_scenes(*args, **kwargs)
+
+    results = []
+    for processes, other_thread in ((1, False), (3, False), (3, True)):
+        # Another thread running in the plugin process rules out fork
+        stop = threading.Event()
+        if other_thread:
+            threading.Thread(target=stop.wait, daemon=True).start()
+        start_methods = set()
+        library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=10)
+        stash = StartMethodLog(library)
+        with tempfile.TemporaryDirectory() as state_dir:
+            config = dict(DEFAULT_SETTINGS, statePath=os.path.join(state_dir, 'run_state.json'),
+                          matchStrategy='prefetch', matchProcesses=processes, pageSize=40, assignBatchSize=1)
+            processor = OrphanSceneProcessor(stash, config)
+            stash.processor = processor
+            processor.process_all()
+        stop.set()
+        results.append((scene_galleries(library), processor.stats, list(processor.folder_matches)))
+        print(f"  processes={processes} {sorted(start_methods)}: {processor.stats}")
+        assert processor.match_pool is None, "The pool should be shut down after the run"
+        if other_thread:
+            assert start_methods == {'spawn'}, "Workers should not be forked while other threads run"
+
+    assert results[0] == results[1] == results[2], \
+        "Results and folder order should not depend on the number of processes"
+
+    print("✓ PASSED: Process pool matching is deterministic")
+
+
+def test_page_waves():
+    """Orphan pages fetched in concurrent waves are the same pages, fetched faster"""
+    print("\n" + "=" * 70)
+    print("TEST 12: Concurrent Page Waves")
+    print("=" * 70)
+
+    pages = {}
+    for concurrency in (1, 4):
+        stash = FakeStash(SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=11), latency=0.01)
+        processor = OrphanSceneProcessor(stash, dict(DEFAULT_SETTINGS, pageSize=20, concurrency=concurrency))
+        started = time.perf_counter()
+        pages[concurrency] = [[scene.id for scene in page] for page in processor.get_orphan_scene_pages()]
+        elapsed = time.perf_counter() - started
+        print(f"  concurrency={concurrency}: {len(pages[concurrency])} pages, "
+              f"{stash.calls['find_scenes']} find_scenes calls in {elapsed:.2f}s")
+    assert pages[1] == pages[4], "Waves should yield the same pages in the same order"
+
+    # Scenes are assigned between the pages of a wave
+    results = []
+    for concurrency in (1, 4):
+        library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=11)
+        stash = FakeStash(library)
+        with tempfile.TemporaryDirectory() as state_dir:
+            processor = run_processor(stash, state_dir, pageSize=20, assignBatchSize=1, concurrency=concurrency)
+        results.append((scene_galleries(library), processor.stats))
+        print(f"  process_all with concurrency={concurrency}: {stash.calls['find_scenes']} find_scenes calls")
+        assert stash.calls['find_scenes'] == 1 + len(pages[1]), "Orphans should be counted once, then paged"
+    assert results[0] == results[1], "Assigning while fetching in waves should not skip scenes"
+
+    print("✓ PASSED: Page waves are complete and ordered")
+
+
+def test_plan_and_apply():
+    """A written plan, applied later, makes the same assignments as a direct run"""
+    print("\n" + "=" * 70)
+    print("TEST 13: Plan and Apply")
+    print("=" * 70)
+
+    expected = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=12)
+    direct_stash = FakeStash(expected)
+    with tempfile.TemporaryDirectory() as state_dir:
+        direct = run_processor(direct_stash, state_dir, assignBatchSize=10)
+
+    for plan_file in ('match_plan.json', 'match_plan.csv'):
+        library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=12)
+        untouched = scene_galleries(library)
+        with tempfile.TemporaryDirectory() as state_dir:
+            settings = dict(DEFAULT_SETTINGS, assignBatchSize=10, planPath=os.path.join(state_dir, plan_file),
+                            statePath=os.path.join(state_dir, 'run_state.json'))
+            stash = FakeStash(library)
+            planner = OrphanSceneProcessor(stash, settings)
+            planner.process_plan()
+            assert scene_galleries(library) == untouched, "Planning should not change the library"
+            assert not os.path.exists(settings['statePath']), "Planning should not record run state"
+            assert len(planner.plan) == direct.stats['assigned']
+            reasons = sorted({entry.reason for entry in planner.plan})
+            assert set(reasons) <= {'same folder', 'child folder', 'parent folder'}
+
+            stash = FakeStash(library)
+            applier = OrphanSceneProcessor(stash, settings)
+            applier.process_apply_plan()
+
+        print(f"  {plan_file}: {len(planner.plan)} planned ({', '.join(reasons)}), "
+              f"applied with {dict(stash.calls)}")
+        assert scene_galleries(library) == scene_galleries(expected), "Applying should match a direct run"
+        assert set(stash.calls) == {'update_scenes'}, "Applying should not look anything up"
+        assert stash.calls['update_scenes'] == direct_stash.calls['update_scenes'], "Assignments should be batched"
+        assert applier.stats['assigned'] == len(planner.plan) and applier.stats['errors'] == 0
+
+    print("✓ PASSED: Plans apply without matching")
+
+
+def test_prefix_with_shared_cache():
+    """Prefix runs do not leave scope-restricted results in the shared folder cache"""
+    print("\n" + "=" * 70)
+    print("TEST 14: Path Prefix With Persistent Cache")
+    print("=" * 70)
+
+    expected = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=9)
+    with tempfile.TemporaryDirectory() as state_dir:
+        full = run_processor(FakeStash(expected), state_dir)
+
+    # A folder only the direct parent matches, made the prefix of a scoped run
+    prefix = next(folder for folder, match in full.folder_matches.items()
+                  if match and match.folder == os.path.dirname(folder))
+
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=9)
+    with tempfile.TemporaryDirectory() as state_dir:
+        scoped = run_processor(FakeStash(library), state_dir, persistentCache=True, pathPrefix=prefix)
+        whole = run_processor(FakeStash(library), state_dir, persistentCache=True)
+
+    print(f"  {prefix}: {scoped.stats['skipped']} skipped in scope, then {whole.stats['assigned']} assigned, "
+          f"{whole.stats['cache_hits']} cache hits")
+    assert scoped.stats['skipped'] > 0, "The prefix run should not match the folder to its parent"
+    assert scene_galleries(library) == scene_galleries(expected), \
+        "A whole-library run should not reuse the prefix run's result"
+
+    print("✓ PASSED: Scoped results stay out of the shared cache")
+
+
+def test_assignments_sent_during_run():
+    """Queued assignments are sent as the run goes, not all at the end"""
+    print("\n" + "=" * 70)
+    print("TEST 15: Assignments Sent During Run")
+    print("=" * 70)
+
+    class WatchedStash(FakeStash):
+        """Records how many scenes were queued whenever a page is requested."""
+        processor = None
+
+        def find_scenes(self, *args, **kwargs):
+            if self.processor is not None:
+                queued.append(self.processor.pending_count)
+                sent.append(self.calls['update_scenes'])
+            return super().find_scenes(*args, **kwargs)
+
+    queued, sent = [], []
+    library = SyntheticLibrary(scenes=1000, images=20000, galleries=300, seed=13)
+    stash = WatchedStash(library)
+    with tempfile.TemporaryDirectory() as state_dir:
+        config = dict(DEFAULT_SETTINGS, statePath=os.path.join(state_dir, 'run_state.json'),
+                      pageSize=50, assignBatchSize=20)
+        processor = OrphanSceneProcessor(stash, config)
+        stash.processor = processor
+        processor.process_all()
+
+    print(f"  {processor.stats['assigned']} assigned in {stash.calls['update_scenes']} updates, "
+          f"{sent[-1]} sent before the last page, at most {max(queued)} queued")
+    assert max(queued) < 20, "The queue should not grow past the batch size"
+    assert sent[-1] > stash.calls['update_scenes'] // 2, "Most assignments should be sent before the run ends"
+    assert processor.pending_count == 0 and not processor.pending_assignments
+
+    print("✓ PASSED: Assignments are sent in batches during the run")
+
+
+def test_natural_path_collation():
+    """Strategies agree when Stash sorts paths case-insensitively and naturally"""
+    print("\n" + "=" * 70)
+    print("TEST 16: Stash Path Collation")
+    print("=" * 70)
+
+    def build():
+        library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=14)
+        # Python's order: B < a < shoot10 < shoot2; Stash's order: a < B < shoot2 < shoot10
+        galleries = {name: library.add_image_folder(f"/library/Mixed/{name}", 3)
+                     for name in ('shoot2', 'shoot10', 'a', 'B')}
+        scene_id = library.add_scene("/library/Mixed")
+        return library, galleries, scene_id
+
+    results = {}
+    for strategy in ('query', 'prefetch', 'galleries', 'firstHit'):
+        library, galleries, scene_id = build()
+        with tempfile.TemporaryDirectory() as state_dir:
+            run_processor(FakeStash(library, collation='natural'), state_dir, matchStrategy=strategy, pageSize=2)
+        results[strategy] = scene_galleries(library)
+        print(f"  {strategy}: scene {scene_id} -> galleries {results[strategy][scene_id]}")
+        assert results[strategy][scene_id] == [galleries['B']], "The first child folder in sorted order should match"
+
+    expected, _, _ = build()
+    with tempfile.TemporaryDirectory() as state_dir:
+        run_processor(FakeStash(expected), state_dir)
+    for strategy, result in results.items():
+        assert result == scene_galleries(expected), f"{strategy} should not depend on Stash's collation"
+
+    print("✓ PASSED: Child folders are picked in the same order whatever the collation")
+
+
+def test_incremental_run():
+    """An incremental run only revisits folders near new galleries and new scenes"""
+    print("\n" + "=" * 70)
+    print("TEST 17: Incremental Run")
+    print("=" * 70)
+
+    class FetchLog(FakeStash):
+        """Records the ids of orphan scenes returned in pages."""
+        def find_scenes(self, *args, **kwargs):
+            result = super().find_scenes(*args, **kwargs)
+            if not kwargs.get('get_count'):
+                fetched.extend(scene['id'] for scene in result)
+            return result
+
+    library = SyntheticLibrary(scenes=2000, images=20000, galleries=200, seed=15)
+    library.add_scene('/library/other/lonely')
+    with tempfile.TemporaryDirectory() as state_dir:
+        full = run_processor(FakeStash(library), state_dir)
+        with open(os.path.join(state_dir, 'run_state.json')) as f:
+            unmatched = set(json.load(f)['unmatched_folders'])
+
+        # A gallery appears in the parent of the unsorted scene folders, and
+        # a scene is added to one of them after the full run
+        unsorted = {folder for folder in unmatched if folder.startswith('/library/unsorted/')}
+        library.add_image_folder('/library/unsorted', 5, updated_at='2999-01-01T00:00:00Z')
+        new_scene = library.add_scene(sorted(unsorted)[0], updated_at='2999-01-01T00:00:00Z')
+        expected = {scene['id'] for scene in library.scenes
+                    if not scene['galleries'] and os.path.dirname(scene['files'][0]['path']) in unsorted}
+
+        fetched = []
+        config = dict(DEFAULT_SETTINGS, statePath=os.path.join(state_dir, 'run_state.json'))
+        processor = OrphanSceneProcessor(FetchLog(library), config)
+        processor.process_incremental()
+        with open(os.path.join(state_dir, 'run_state.json')) as f:
+            still_unmatched = set(json.load(f)['unmatched_folders'])
+
+    print(f"  Full run: {full.stats['assigned']} assigned, {len(unmatched)} unmatched folders "
+          f"({len(unsorted)} near the new gallery)")
+    print(f"  Incremental: {len(fetched)} scenes fetched, {processor.stats}")
+    assert len(unsorted) > 100, "Retried folders should span several folder filters"
+    assert new_scene in expected
+    assert set(fetched) == expected, "Only the new scene and scenes near the new gallery should be fetched"
+    assert fetched.count(new_scene) == 2, "The new scene is in both the updated and the retried folder filters"
+    assert processor.stats['assigned'] == len(expected), "Each scene should be assigned once"
+    assert not unsorted & still_unmatched, "Matched folders should leave the unmatched list"
+    assert still_unmatched == unmatched - unsorted == {'/library/other/lonely'}, \
+        "Other unmatched folders should be kept"
+
+    print("✓ PASSED: Incremental runs only process what changed")
+
+
+def test_new_scene_hook():
+    """The scene hook assigns one new scene with a few calls and no library fetch"""
+    print("\n" + "=" * 70)
+    print("TEST 18: New Scene Hook")
+    print("=" * 70)
+
+    def run_hook(library, scene_id, **settings):
+        stash = FakeStash(library)
+        config = dict(DEFAULT_SETTINGS, enableHooks=True)
+        config.update(settings)
+        processor = OrphanSceneProcessor(stash, config)
+        processor.process_hook({'type': 'Scene.Create.Post', 'id': int(scene_id)})
+        return stash
+
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=16)
+    folder = library.galleries['1']['folder']['path']
+
+    for strategy in ('query', 'prefetch', 'galleries', 'firstHit'):
+        scene_id = library.add_scene(folder)
+        stash = run_hook(library, scene_id, matchStrategy=strategy)
+        print(f"  {strategy}: scene {scene_id} -> {library.scenes[-1]['galleries']} with {dict(stash.calls)}")
+        assert library.scenes[-1]['galleries'] == [{'id': '1'}], \
+            "The new scene should be assigned to its folder's gallery"
+        assert 'find_scenes' not in stash.calls, "The hook should not fetch orphan scenes"
+        assert sum(stash.calls.values()) <= 5 and stash.calls['update_scenes'] == 1
+
+    scene_id = library.add_scene(folder)
+    stash = run_hook(library, scene_id, enableHooks=False)
+    assert not stash.calls, "With hooks disabled nothing should be queried"
+    assert not library.scenes[-1]['galleries']
+
+    galleried = next(scene for scene in library.scenes if scene['galleries'])
+    stash = run_hook(library, galleried['id'])
+    assert set(stash.calls) == {'find_scene'}, "Scenes that already have a gallery should be skipped"
+
+    library.scenes[-1]['organized'] = True
+    stash = run_hook(library, scene_id, excludeOrganized=True)
+    assert set(stash.calls) == {'find_scene'}, "Organized scenes should be skipped when excluded"
+    assert not library.scenes[-1]['galleries']
+
+    print("✓ PASSED: New scenes are assigned by the hook alone")
+
+
+def test_gallery_scene_filter():
+    """The new gallery hook's scene filter selects exactly the scenes the gallery matches"""
+    print("\n" + "=" * 70)
+    print("TEST 19: New Gallery Scene Filter")
+    print("=" * 70)
+
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=17)
+    processor = OrphanSceneProcessor(FakeStash(library), dict(DEFAULT_SETTINGS))
+
+    rng = random.Random(1357)
+    checked = 0
+    for trial in range(100):
+        # Random trees with similar-prefix siblings and regex metacharacters
+        folders = ['/media']
+        for _ in range(rng.randint(3, 25)):
+            name = rng.choice(['a', 'b', 'a-b', 'a.b', 'a+b', 'ab', 'pics', 'video', '(1)'])
+            folders.append(rng.choice(folders) + '/' + name)
+        scene_folders = sorted(set(folders)) + ['/']
+        gallery_folders = sorted(set(folders)) + [rng.choice(folders) + '/set.zip']
+
+        for gallery_folder in gallery_folders:
+            criterion = processor.get_gallery_scene_filter(gallery_folder)['path']
+            selected, expected = set(), set()
+            for scene_folder in scene_folders:
+                path = str(Path(scene_folder) / 'scene.mp4')
+                parent = str(Path(scene_folder).parent)
+                matches = should_match_folder(gallery_folder, scene_folder, parent)
+                if matches:
+                    expected.add(scene_folder)
+                if match_string(path, criterion) and matches:
+                    selected.add(scene_folder)
+            assert selected == expected, (
+                f"Trial {trial}: filter for {gallery_folder} selects {sorted(selected)}, expected {sorted(expected)}"
+            )
+            checked += 1
+    print(f"  {checked} gallery folders checked against should_match_folder")
+
+    # The hook assigns exactly those orphans
+    orphan = next(scene for scene in library.scenes if not scene['galleries'])
+    folder = os.path.dirname(orphan['files'][0]['path']) + '/new'
+    expected = set()
+    for scene in library.scenes:
+        scene_folder = os.path.dirname(scene['files'][0]['path'])
+        if not scene['galleries'] and should_match_folder(folder, scene_folder, os.path.dirname(scene_folder)):
+            expected.add(scene['id'])
+    gallery_id = library.add_image_folder(folder, 3)
+    config = dict(DEFAULT_SETTINGS, enableHooks=True)
+    OrphanSceneProcessor(FakeStash(library), config).process_hook({'type': 'Gallery.Create.Post', 'id': gallery_id})
+    assigned = {scene['id'] for scene in library.scenes if {'id': gallery_id} in scene['galleries']}
+    print(f"  New gallery in {folder}: {len(assigned)} orphan scenes assigned")
+    assert assigned == expected and assigned, "The hook should assign the orphans the new gallery matches"
+
+    print("✓ PASSED: Gallery scene filter is the inverse of should_match_folder")
+
+
+class PausingStash(FakeStash):
+    """FakeStash that stops before serving the second page of scenes until released."""
+
+    def __init__(self, library):
+        super().__init__(library)
+        self.paused = threading.Event()
+        self.release = threading.Event()
+        self.pages = 0
+
+    def find_scenes(self, f={}, filter={"per_page": -1}, q="", fragment=None, get_count=False, callback=None):
+        if not get_count:
+            self.pages += 1
+            if self.pages == 2:
+                self.paused.set()
+                self.release.wait(60)
+        return super().find_scenes(f, filter, q, fragment, get_count, callback)
+
+
+def test_shards_share_cache():
+    """Shards running at the same time share one persistent cache file"""
+    print("\n" + "=" * 70)
+    print("TEST 20: Concurrent Shards Sharing the Folder Cache")
+    print("=" * 70)
+
+    expected = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=9)
+    with tempfile.TemporaryDirectory() as state_dir:
+        run_processor(FakeStash(expected), state_dir)
+
+    library = SyntheticLibrary(scenes=300, images=6000, galleries=60, seed=9)
+    paused = PausingStash(library)
+    with tempfile.TemporaryDirectory() as state_dir:
+        # Shard 1 stops halfway, after caching its first page of folders
+        first = threading.Thread(target=run_processor, args=(paused, state_dir),
+                                 kwargs=dict(persistentCache=True, shard="1/2", pageSize=50))
+        first.start()
+        assert paused.paused.wait(60), "Shard 1 should reach its second page"
+        try:
+            started = time.perf_counter()
+            second = run_processor(FakeStash(library), state_dir, persistentCache=True, shard="2/2")
+            elapsed = time.perf_counter() - started
+        finally:
+            paused.release.set()
+            first.join()
+        rerun = run_processor(FakeStash(library), state_dir, persistentCache=True)
+
+    print(f"  Shard 2 ran in {elapsed:.1f}s while shard 1 was paused, {second.stats['folders']} folders, "
+          f"then {rerun.stats['cache_hits']} cache hits")
+    assert elapsed < 10, "Shard 2 should not wait on shard 1's cache lock"
+    assert scene_galleries(library) == scene_galleries(expected), "Shards together should do the full run"
+    assert rerun.stats['cache_hits'] == rerun.stats['folders'] > 0, \
+        "Both shards' folders should be in the shared cache"
+
+    print("✓ PASSED: Concurrent shards share the folder cache")
+
+
+def test_bounded_child_search():
+    """A scene folder high up the tree does not read every image below it"""
+    print("\n" + "=" * 70)
+    print("TEST 21: Bounded Child Folder Search")
+    print("=" * 70)
+
+    for strategy in ('query', 'firstHit'):
+        library = SyntheticLibrary(scenes=0, images=0, galleries=0, seed=21)
+        # Stash lists the shoots first, but Python sorts Zeta before them
+        for n in range(1, 41):
+            library.add_image_folder(f"/library/Big/shoot{n}", 50, gallery=n > 3)
+        zeta = library.add_image_folder("/library/Big/Zeta", 50)
+        scene_id = library.add_scene("/library/Big")
+
+        stash = FakeStash(library, collation='natural')
+        transferred = []
+        find_images = stash.find_images
+
+        def counting_find_images(*args, **kwargs):
+            images = find_images(*args, **kwargs)
+            transferred.extend(images)
+            return images
+
+        stash.find_images = counting_find_images
+        with tempfile.TemporaryDirectory() as state_dir:
+            run_processor(stash, state_dir, matchStrategy=strategy, pageSize=100)
+
+        print(f"  {strategy}: scene {scene_id} -> galleries {scene_galleries(library)[scene_id]}, "
+              f"{len(transferred)} of {library.image_count()} images in {stash.calls['find_images']} requests")
+        assert scene_galleries(library)[scene_id] == [zeta], "The first child folder in sorted order should match"
+        assert len(transferred) < 500, "The search should stop well before reading every image"
+        if strategy == 'firstHit':
+            assert len(transferred) <= stash.calls['find_images'], "firstHit should ask for one image at a time"
+
+    print("✓ PASSED: Child folder search stops once no earlier folder is left")
+
+
+def run_all_tests():
+    """Run all tests"""
+    print("\n" + "=" * 70)
+    print("RUNNING ALL PROCESSOR TESTS")
+    print("=" * 70)
+
+    try:
+        test_fake_path_filters()
+        test_strategies_agree()
+        test_concurrency_and_batching()
+        test_failed_assignment_is_isolated()
+        test_run_metrics()
+        test_record_and_replay()
+        test_compact_records()
+        test_resume_from_checkpoint()
+        test_time_budget()
+        test_shards()
+        test_match_processes()
+        test_page_waves()
+        test_plan_and_apply()
+        test_prefix_with_shared_cache()
+        test_assignments_sent_during_run()
+        test_natural_path_collation()
+        test_incremental_run()
+        test_new_scene_hook()
+        test_gallery_scene_filter()
+        test_shards_share_cache()
+        test_bounded_child_search()
+
+        print("\n" + "=" * 70)
+        print("✓✓✓ ALL TESTS PASSED ✓✓✓")
+        print("=" * 70)
+        return True
+
+    except AssertionError as e:
+        print("\n✗✗✗ TEST FAILED ✗✗✗")
+        print(f"Error: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    exit(0 if success else 1)